@@ -0,0 +1,177 @@
+"""
+asyncio wrappers around the blocking ankix API, for use from async web servers.
+
+Every call is run on a bounded thread pool. Each worker thread opens its own
+SQLite connection (peewee keeps connections thread-local) and keeps it for the
+lifetime of the pool, so the event loop never blocks on a query, a render or a
+``magic`` call.
+
+Concurrency limits:
+
+- At most ``max_workers`` calls run at once; further calls wait in the pool queue.
+- SQLite allows many concurrent readers but only one writer. Grading calls
+  (``right``, ``wrong``, ``bury``) are serialized by SQLite itself, and a long
+  write blocks readers unless the database is in WAL mode
+  (``ankix.init(path, pragmas={'journal_mode': 'wal'})``).
+- For read-only serving, ``ankix.init(path, readonly=True)`` opens an immutable,
+  memory-mapped snapshot; readers then never wait on locks.
+- ``config`` is process-global, so ``ankix.update_config`` affects every worker.
+- Rendering is CPU-bound Python and holds the GIL, so more workers improve
+  latency under I/O wait, not rendering throughput.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import db
+
+DEFAULT_MAX_WORKERS = 4
+
+_executor = None
+
+
+def _connect():
+    db.database.connect(reuse_if_open=True)
+
+
+def init_pool(max_workers=DEFAULT_MAX_WORKERS):
+    """
+    (Re)create the worker pool. Call after ``ankix.init``.
+    :param int max_workers:
+    :return:
+    """
+    global _executor
+
+    shutdown()
+    _executor = ThreadPoolExecutor(max_workers=max_workers,
+                                   thread_name_prefix='ankix',
+                                   initializer=_connect)
+
+    return _executor
+
+
+def shutdown(wait=True):
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+
+
+async def run(func, *args, **kwargs):
+    """
+    Run any blocking ankix callable on the worker pool.
+    :param func:
+    :return: the return value of func
+    """
+    if _executor is None:
+        init_pool()
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+def _search(cls, kwargs):
+    return list(cls.search(**kwargs))
+
+
+async def search(**kwargs):
+    """
+    Same arguments as ``db.Card.search``.
+    :return: list of Card
+    """
+    return await run(_search, db.Card, kwargs)
+
+
+async def search_notes(**kwargs):
+    """
+    Same arguments as ``db.Note.search``.
+    :return: list of Note
+    """
+    return await run(_search, db.Note, kwargs)
+
+
+def _load_card(card_id):
+    db_cards = db.Card.load_for_render([card_id])
+    if not db_cards:
+        raise db.Card.DoesNotExist('Card {} does not exist'.format(card_id))
+
+    return db_cards[0]
+
+
+async def get_card(card_id):
+    return await run(_load_card, card_id)
+
+
+def _render(card):
+    if not isinstance(card, db.Card):
+        card = _load_card(card)
+
+    question = card.question
+    answer = card._render_answer(question.raw)
+
+    return {
+        'id': card.id,
+        'question': str(question),
+        'answer': str(answer),
+        'html': card._html(question, answer)
+    }
+
+
+async def render(card):
+    """
+    Render a card off the event loop.
+    :param db.Card|int card:
+    :return: dict of id, question, answer and html, all str
+    """
+    return await run(_render, card)
+
+
+async def question(card):
+    return (await render(card))['question']
+
+
+async def answer(card):
+    return (await render(card))['answer']
+
+
+async def right(card, **kwargs):
+    await run(card.right, **kwargs)
+
+
+async def wrong(card, **kwargs):
+    await run(card.wrong, **kwargs)
+
+
+async def bury(card, **kwargs):
+    await run(card.bury, **kwargs)
+
+
+def _shuffled_ids(kwargs):
+    return db.Card.shuffled_ids(db.Card.search(**kwargs))
+
+
+async def iter_quiz(template_name=None, model_name=None, deck_name=None, tags=None, deck_path=None,
+                    batch_size=50):
+    """
+    Async counterpart of ``db.Card.iter_quiz``.
+
+    >>> async for card in aio.iter_quiz(deck_name='foo'):
+    ...     html = await aio.render(card)
+    """
+    card_ids = await run(_shuffled_ids, dict(
+        template_name=template_name,
+        model_name=model_name,
+        deck_name=deck_name,
+        tags=tags,
+        deck_path=deck_path
+    ))
+
+    for i in range(0, len(card_ids), batch_size):
+        for db_card in await run(db.Card.load_for_render, card_ids[i:i + batch_size]):
+            yield db_card
+
+
+iter_due = iter_quiz
@@ -6,19 +6,40 @@ from tqdm import tqdm
 import os
 import re
 import logging
+import peewee as pv
 
 from .config import config
-from .util import MediaType
+from .util import MediaType, parse_cloze
 from . import db
+from .ingest import ingest_media
 
 
-def init(database, **kwargs):
-    db.database.init(database, **kwargs)
+def init(database, readonly=False, **kwargs):
+    """
+
+    :param str database: path to the .ankix file; created if it doesn't exist
+    :param bool readonly: open as a read-only, memory-mapped snapshot, so that many reader
+                          processes can share one file. Writes raise db.ReadOnlyError.
+                          Pass immutable=False if another process may write to the file.
+    :param kwargs: passed to SqliteDatabase.init
+    :return:
+    """
+    if readonly and not os.path.exists(database):
+        raise FileNotFoundError(database)
+
+    db.database.init(database, readonly=readonly, **kwargs)
     if not os.path.exists(database):
         db.create_all_tables()
+        db.SchemaVersion.create(version=db.SCHEMA_VERSION)
+
+    if readonly and db.Settings.table_exists() and db.Settings.get_or_none() is not None:
+        config.update(db.Settings.to_dict())
 
 
 def update_config(markdown=False, srs=None):
+    if db.database.readonly:
+        raise db.ReadOnlyError('{} is opened read-only; cannot update Settings'.format(db.database.path))
+
     config.update(markdown=markdown, srs=srs)
     if db.Settings.get_or_none() is None:
         db.Settings().save()
@@ -26,11 +47,14 @@ def update_config(markdown=False, srs=None):
         config.update(db.Settings.to_dict())
 
 
-def import_apkg(src_apkg, skip_media=False):
+def import_apkg(src_apkg, skip_media=False, stream=False, chunk_size=1000):
     """
 
     :param src_apkg:
     :param bool|list skip_media:
+    :param bool stream: read notes and cards in chunks, and keep media references in a temporary
+                        SQLite table instead of in memory, so that memory use doesn't grow with the collection
+    :param int chunk_size: notes or cards per chunk, in stream mode
     :return:
     """
     info = dict()
@@ -75,66 +99,16 @@ def import_apkg(src_apkg, skip_media=False):
                         name=deck['name']
                     )
 
-                c = conn.execute('''SELECT * FROM notes''')
-                for note in tqdm(c.fetchall(), desc='notes'):
-                    info_model = info['model'][note['mid']]
-                    header = [field['name'] for field in info_model['flds']]
-
-                    db_note = db.Note.create(
-                        id=note['id'],
-                        model_id=note['mid'],
-                        data=dict(zip(header, note['flds'].split('\u001f')))
-                    )
+                if stream:
+                    _create_media_refs(info)
+                    _stream_notes(conn, info, chunk_size)
+                    _stream_cards(conn, chunk_size)
+                else:
+                    _import_notes(conn, info)
+                    _import_cards(conn, info)
 
-                    for tag in set(t for t in note['tags'].split(' ') if t):
-                        db_tag = db.Tag.get_or_create(
-                            name=tag
-                        )[0]
-
-                        db_tag.notes.add(db_note)
-
-                    info.setdefault('note', dict())[note['id']] = dict(note)
-
-                    for media_name in re.findall(r'src=[\'\"]((?!.*//)[^\'\"]+)[\'\"]', note['flds']):
-                        info.setdefault('media', dict())\
-                            .setdefault(MediaType.image, dict())\
-                            .setdefault(media_name, [])\
-                            .append(note['id'])
-
-                    for media_name in re.findall(r'\[sound:[^\]]+\]', note['flds']):
-                        info.setdefault('media', dict()) \
-                            .setdefault(MediaType.audio, dict()) \
-                            .setdefault(media_name, []) \
-                            .append(note['id'])
-
-                c = conn.execute('''SELECT * FROM cards''')
-                for card in tqdm(c.fetchall(), desc='cards'):
-                    info_note = info['note'][card['nid']]
-                    info_model = info['model'][info_note['mid']]
-                    db_model = db.Model.get(id=info_model['id'])
-                    db_template = db_model.templates[0]
-
-                    if '{{cloze:' not in db_template.question:
-                        db_template = db_model.templates[card['ord']]
-                        db.Card.create(
-                            id=card['id'],
-                            note_id=card['nid'],
-                            deck_id=card['did'],
-                            template_id=db_template.id
-                        )
-                    else:
-                        for db_template_n in db_model.templates:
-                            db.Card.create(
-                                id=card['id'],
-                                note_id=card['nid'],
-                                deck_id=card['did'],
-                                cloze_order=card['ord'] + 1,
-                                template_id=db_template_n.id
-                            )
-
-                for db_deck in db.Deck.select():
-                    if not db_deck.cards:
-                        db_deck.delete_instance()
+                for db_deck in db.Deck.select().where(db.Deck.id.not_in(db.Card.select(db.Card.deck))):
+                    db_deck.delete_instance()
             finally:
                 conn.close()
 
@@ -143,27 +117,275 @@ def import_apkg(src_apkg, skip_media=False):
                     skip_media = []
 
                 with open(os.path.join(temp_dir, 'media')) as f:
-                    info_media = info.get('media', dict())
-                    for media_id, media_name in tqdm(json.load(f).items(), desc='media'):
-                        with open(os.path.join(temp_dir, media_id), 'rb') as image_f:
-                            db_media = db.Media.create(
-                                id=int(media_id),
-                                name=media_name,
-                                data=image_f.read()
-                            )
-
-                            if MediaType.image not in skip_media:
-                                for note_id in info_media.get(MediaType.image, dict()).get(media_name, []):
-                                    db_media.notes.add(db.Note.get(id=note_id))
-
-                            if MediaType.audio not in skip_media:
-                                for note_id in info_media.get(MediaType.audio, dict()).get(media_name, []):
-                                    db_media.notes.add(db.Note.get(id=note_id))
-
-                            if MediaType.font not in skip_media:
-                                for model_id in info_media.get(MediaType.font, dict()).get(media_name, []):
-                                    db_media.models.add(db.Model.get(id=model_id))
-
-                            if not db_media.notes and db_media.models:
-                                logging.error('%s not connected to Notes or Models. Deleting...', media_name)
-                                db_media.delete_instance()
+                    media_files = [(media_name, os.path.join(temp_dir, media_id))
+                                   for media_id, media_name in json.load(f).items()]
+
+                name_to_id = ingest_media(media_files, type_=MediaType.font)
+
+                if stream:
+                    _link_media_refs(name_to_id, skip_media)
+                else:
+                    _link_media(info, name_to_id, skip_media)
+
+            if stream:
+                db.database.execute_sql('DROP TABLE IF EXISTS temp.import_media_ref')
+
+
+def _import_notes(conn, info):
+    c = conn.execute('''SELECT * FROM notes''')
+    for note in tqdm(c.fetchall(), desc='notes'):
+        info_model = info['model'][note['mid']]
+        header = [field['name'] for field in info_model['flds']]
+
+        db_note = db.Note.create(
+            id=note['id'],
+            model_id=note['mid'],
+            data=dict(zip(header, note['flds'].split('\u001f')))
+        )
+
+        for tag in set(t for t in note['tags'].split(' ') if t):
+            db_tag = db.Tag.get_or_create(
+                name=tag
+            )[0]
+
+            db_tag.notes.add(db_note)
+
+        info.setdefault('note', dict())[note['id']] = dict(note, cloze=db_note.cloze)
+
+        for media_name in re.findall(r'src=[\'\"]((?!.*//)[^\'\"]+)[\'\"]', note['flds']):
+            info.setdefault('media', dict())\
+                .setdefault(MediaType.image, dict())\
+                .setdefault(media_name, [])\
+                .append(note['id'])
+
+        for media_name in re.findall(r'\[sound:[^\]]+\]', note['flds']):
+            info.setdefault('media', dict()) \
+                .setdefault(MediaType.audio, dict()) \
+                .setdefault(media_name, []) \
+                .append(note['id'])
+
+
+def _import_cards(conn, info):
+    c = conn.execute('''SELECT * FROM cards''')
+    for card in tqdm(c.fetchall(), desc='cards'):
+        info_note = info['note'][card['nid']]
+        info_model = info['model'][info_note['mid']]
+        db_model = db.Model.get(id=info_model['id'])
+        db_template = db_model.templates[0]
+
+        if '{{cloze:' not in db_template.question:
+            db_template = db_model.templates[card['ord']]
+            db.Card.create(
+                id=card['id'],
+                note_id=card['nid'],
+                deck_id=card['did'],
+                template_id=db_template.id
+            )
+        else:
+            cloze = info_note['cloze']
+            if cloze is None or card['ord'] + 1 not in cloze['ords']:
+                continue
+
+            for db_template_n in db_model.templates:
+                db.Card.create(
+                    id=card['id'],
+                    note_id=card['nid'],
+                    deck_id=card['did'],
+                    cloze_order=card['ord'] + 1,
+                    template_id=db_template_n.id
+                )
+
+
+def _link_media(info, name_to_id, skip_media):
+    info_media = info.get('media', dict())
+    note_links = set()
+    model_links = set()
+    for media_name, media_id in name_to_id.items():
+        if MediaType.image not in skip_media:
+            for note_id in info_media.get(MediaType.image, dict()).get(media_name, []):
+                note_links.add((note_id, media_id))
+        if MediaType.audio not in skip_media:
+            for note_id in info_media.get(MediaType.audio, dict()).get(media_name, []):
+                note_links.add((note_id, media_id))
+        if MediaType.font not in skip_media:
+            for model_id in info_media.get(MediaType.font, dict()).get(media_name, []):
+                model_links.add((model_id, media_id))
+
+    media_ids = list(set(name_to_id.values()))
+    note_links |= _insert_links(db.NoteMedia, db.NoteMedia.note, note_links, media_ids)
+    model_links |= _insert_links(db.ModelFont, db.ModelFont.model, model_links, media_ids)
+
+    linked_notes = set(media_id for _, media_id in note_links)
+    linked_models = set(media_id for _, media_id in model_links)
+    for media_name, media_id in name_to_id.items():
+        if media_id not in linked_notes and media_id in linked_models:
+            logging.error('%s not connected to Notes or Models. Deleting...', media_name)
+            db.Media.get_by_id(media_id).discard(media_name)
+
+
+def _fetch_chunks(c, chunk_size):
+    while True:
+        rows = c.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        yield rows
+
+
+def _create_media_refs(info):
+    """
+    Temporary table of (kind, media name, note or model id), filled while streaming notes
+    """
+    db.database.execute_sql('DROP TABLE IF EXISTS temp.import_media_ref')
+    db.database.execute_sql('CREATE TEMP TABLE import_media_ref (kind TEXT, name TEXT, owner_id INTEGER)')
+    _insert_media_refs([(MediaType.font, media_name, model_id) for media_name, model_ids
+                        in info.get('media', dict()).get(MediaType.font, dict()).items()
+                        for model_id in model_ids])
+
+
+def _insert_media_refs(refs):
+    if refs:
+        db.database.cursor().executemany('INSERT INTO temp.import_media_ref VALUES (?, ?, ?)', refs)
+
+
+def _stream_notes(conn, info, chunk_size):
+    headers = {model_id: [field['name'] for field in model['flds']] for model_id, model in info['model'].items()}
+    tag_ids = dict()
+
+    n = conn.execute('''SELECT COUNT(*) FROM notes''').fetchone()[0]
+    c = conn.execute('''SELECT id, mid, tags, flds FROM notes''')
+    with tqdm(total=n, desc='notes') as pbar:
+        for notes in _fetch_chunks(c, chunk_size):
+            note_rows = []
+            tag_rows = set()
+            media_refs = []
+            for note in notes:
+                d = db.clean_note_data(dict(zip(headers[note['mid']], note['flds'].split('\u001f'))))
+                note_rows.append({
+                    'id': note['id'],
+                    'model': note['mid'],
+                    'data': d,
+                    'h': db.note_hash(d),
+                    'cloze': parse_cloze(d)
+                })
+
+                for tag in set(t for t in note['tags'].split(' ') if t):
+                    if tag not in tag_ids:
+                        tag_ids[tag] = db.Tag.get_or_create(name=tag)[0].id
+                    tag_rows.add((note['id'], tag_ids[tag]))
+
+                for media_name in re.findall(r'src=[\'\"]((?!.*//)[^\'\"]+)[\'\"]', note['flds']):
+                    media_refs.append((MediaType.image, media_name, note['id']))
+
+                for media_name in re.findall(r'\[sound:[^\]]+\]', note['flds']):
+                    media_refs.append((MediaType.audio, media_name, note['id']))
+
+            for row_batch in pv.chunked(note_rows, db.INSERT_BATCH_SIZE):
+                db.Note.insert_many(row_batch).execute()
+
+            tag_rows = [{'note': note_id, 'tag': tag_id} for note_id, tag_id in tag_rows]
+            for row_batch in pv.chunked(tag_rows, db.INSERT_BATCH_SIZE):
+                db.NoteTag.insert_many(row_batch).execute()
+
+            _insert_media_refs(media_refs)
+            pbar.update(len(notes))
+
+
+def _stream_cards(conn, chunk_size):
+    model_templates = dict()
+
+    n = conn.execute('''SELECT COUNT(*) FROM cards''').fetchone()[0]
+    c = conn.execute('''SELECT cards.id, cards.nid, cards.did, cards.ord, notes.mid
+                        FROM cards JOIN notes ON notes.id = cards.nid''')
+    with tqdm(total=n, desc='cards') as pbar:
+        for cards in _fetch_chunks(c, chunk_size):
+            db_notes = {db_note.id: db_note for db_note in
+                        db.Note.select().where(db.Note.id.in_(list(set(card['nid'] for card in cards))))}
+
+            card_rows = []
+            for card in cards:
+                if card['mid'] not in model_templates:
+                    db_model = db.Model.get(id=card['mid'])
+                    model_templates[card['mid']] = list(db_model.templates)
+                    for db_template in model_templates[card['mid']]:
+                        db_template.model = db_model
+
+                db_templates = model_templates[card['mid']]
+                db_note = db_notes[card['nid']]
+                if '{{cloze:' not in db_templates[0].question:
+                    to_create = [(db_templates[card['ord']], None)]
+                else:
+                    if db_note.cloze is None or card['ord'] + 1 not in db_note.cloze['ords']:
+                        continue
+
+                    to_create = [(db_template, card['ord'] + 1) for db_template in db_templates]
+
+                for db_template, cloze_order in to_create:
+                    db_card = db.Card(note=db_note, template=db_template, cloze_order=cloze_order)
+                    db_card._loaded = {'media': [], 'fonts': [], 'tags': []}
+                    card_rows.append({
+                        'id': card['id'],
+                        'note': card['nid'],
+                        'deck': card['did'],
+                        'template': db_template.id,
+                        'cloze_order': cloze_order,
+                        'h': db.card_hash(db_card)
+                    })
+
+            for row_batch in pv.chunked(card_rows, db.INSERT_BATCH_SIZE):
+                db.Card.insert_many(row_batch).execute()
+
+            pbar.update(len(cards))
+
+
+def _link_media_refs(name_to_id, skip_media):
+    """
+    Link media to notes and models by joining import_media_ref against the imported names, in SQL
+    """
+    db.database.execute_sql('DROP TABLE IF EXISTS temp.import_media')
+    db.database.execute_sql('CREATE TEMP TABLE import_media (name TEXT PRIMARY KEY, media_id INTEGER)')
+    db.database.cursor().executemany('INSERT INTO temp.import_media VALUES (?, ?)', name_to_id.items())
+
+    for through_model, owner_field, kinds in [
+        (db.NoteMedia, db.NoteMedia.note, [MediaType.image, MediaType.audio]),
+        (db.ModelFont, db.ModelFont.model, [MediaType.font])
+    ]:
+        kinds = [k for k in kinds if k not in skip_media]
+        if kinds:
+            db.database.execute_sql(
+                '''INSERT OR IGNORE INTO "{}" ("{}", "media_id")
+                   SELECT DISTINCT r.owner_id, m.media_id FROM temp.import_media_ref r
+                   JOIN temp.import_media m ON m.name = r.name
+                   WHERE r.kind IN ({})'''.format(through_model._meta.table_name, owner_field.column_name,
+                                                ', '.join('?' * len(kinds))),
+                kinds
+            )
+
+    c = db.database.execute_sql(
+        '''SELECT name, media_id FROM temp.import_media
+           WHERE media_id NOT IN (SELECT media_id FROM "{}")
+           AND media_id IN (SELECT media_id FROM "{}")'''.format(db.NoteMedia._meta.table_name,
+                                                            db.ModelFont._meta.table_name)
+    )
+    for media_name, media_id in c.fetchall():
+        logging.error('%s not connected to Notes or Models. Deleting...', media_name)
+        db.Media.get_by_id(media_id).discard(media_name)
+
+    db.database.execute_sql('DROP TABLE temp.import_media')
+
+
+def _insert_links(through_model, owner_field, links, media_ids, chunk_size=300):
+    """
+    Insert (owner id, media id) rows into a many-to-many through table, skipping existing ones.
+    :return: the existing links
+    """
+    existing = set()
+    for i in range(0, len(media_ids), chunk_size):
+        existing.update(through_model.select(owner_field, through_model.media)
+                        .where(through_model.media.in_(media_ids[i:i + chunk_size])).tuples())
+
+    rows = [{owner_field.name: owner_id, 'media': media_id} for owner_id, media_id in links - existing]
+    for row_batch in pv.chunked(rows, db.INSERT_BATCH_SIZE):
+        through_model.insert_many(row_batch).execute()
+
+    return existing
@@ -0,0 +1,298 @@
+"""
+Optional zstd compression of Note.data and Media.data (`pip install ankix[compress]`).
+
+Dictionaries are trained on the collection itself and stored in db.CompressionDict, so
+small rows (a note's JSON, an SVG) still compress well. Rows are compressed one by one,
+and reading Note.data / Media.data decompresses them transparently.
+
+>>> from ankix import compress
+>>> compress.benchmark()
+>>> compress.compress_collection()
+>>> compress.benchmark()
+"""
+
+from tqdm import tqdm
+import peewee as pv
+import threading
+import json
+import random
+import time
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'\x28\xb5\x2f\xfd'  # zstd frame header
+KINDS = ('note', 'media')
+
+
+def _require():
+    if zstandard is None:
+        raise ImportError('zstandard is required for compressed collections: pip install ankix[compress]')
+
+
+class Codec:
+    """
+    zstd compressor/decompressor pair for one dictionary (or none), one instance per thread.
+    """
+
+    def __init__(self, dict_data=None, level=3):
+        _require()
+        self.level = level
+        self.dict = zstandard.ZstdCompressionDict(bytes(dict_data)) if dict_data else None
+        self.dict_id = self.dict.dict_id() if self.dict else 0
+        self._local = threading.local()
+
+    def compress(self, b):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dict)
+
+        return compressor.compress(b)
+
+    def decompress(self, b):
+        decompressor = getattr(self._local, 'decompressor', None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self.dict)
+
+        return decompressor.decompress(b)
+
+
+class CodecRegistry:
+    """
+    Codecs of every stored dictionary, by zstd dictionary id; the newest one of each kind
+    compresses new rows, older ones still decompress rows written before retraining.
+    """
+    MIN_RATIO = 0.9  # store the compressed row only if it saves at least 10%
+
+    def __init__(self):
+        self.stale = True
+        self.active = dict()
+        self.by_dict_id = dict()
+        self.kinds = set()  # kinds that may have compressed rows
+
+    def load(self, rows):
+        """
+        :param rows: (kind, data, level, active) of db.CompressionDict, oldest first
+        """
+        active = dict()
+        by_dict_id = dict()
+        kinds = set()
+        for kind, data, level, is_active in rows:
+            codec = Codec(data, level)
+            if is_active:
+                active[kind] = codec
+            by_dict_id[codec.dict_id] = codec
+            kinds.add(kind)
+
+        self.active, self.by_dict_id, self.kinds = active, by_dict_id, kinds
+        self.stale = False
+
+    def enabled(self, kind=None):
+        if kind is None:
+            return bool(self.active)
+
+        return kind in self.active
+
+    def compress(self, kind, b, force=False):
+        """
+        :param str kind: 'note' or 'media'
+        :param bytes b:
+        :param bool force: keep the compressed frame even if it is not smaller
+        :return: compressed bytes, or None if compression is off or doesn't pay off
+        """
+        codec = self.active.get(kind)
+        if codec is None:
+            return None
+
+        c = codec.compress(b)
+        if not force and len(c) > len(b) * self.MIN_RATIO:
+            return None
+
+        return c
+
+    def decompress(self, b):
+        _require()
+        dict_id = zstandard.get_frame_parameters(b).dict_id
+        if dict_id not in self.by_dict_id:
+            raise ValueError('No compression dictionary with id {}'.format(dict_id))
+
+        return self.by_dict_id[dict_id].decompress(b)
+
+
+registry = CodecRegistry()
+
+
+def train_dictionary(samples, dict_size=110 << 10):
+    """
+    :param list samples: list of bytes
+    :param int dict_size:
+    :return: dictionary bytes, or None if there are too few samples to train on
+    """
+    _require()
+    dict_size = min(dict_size, sum(len(b) for b in samples) // 10)
+    if len(samples) < 8 or dict_size < 1024:
+        return None
+
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError:
+        return None
+
+
+def _sample_ids(model, sample_size):
+    ids = [r[0] for r in model.select(model.id).tuples()]
+
+    return random.sample(ids, min(sample_size, len(ids)))
+
+
+def _raw_samples(kind, sample_size, max_sample_bytes):
+    from . import db
+
+    if kind == 'note':
+        return [db.Note.data.to_bytes(data) for data, in db.Note.select(db.Note.data)
+                .where(db.Note.id.in_(_sample_ids(db.Note, sample_size))).tuples()]
+
+    return [bytes(data[:max_sample_bytes]) for data, in db.Media.select(db.Media.data)
+            .where(db.Media.id.in_(_sample_ids(db.Media, sample_size))).tuples()]
+
+
+def compress_collection(kinds=KINDS, level=3, dict_size=110 << 10, sample_size=2000,
+                        max_sample_bytes=64 << 10, chunk_size=500, vacuum=True):
+    """
+    Train a dictionary per kind on a sample of the collection, then rewrite every row
+    compressed with it. Rows that don't shrink by 10% (e.g. PNG, MP3) are kept as they are.
+    Running it again retrains and recompresses.
+    :param tuple kinds: 'note' and/or 'media'
+    :param int level: zstd level
+    :param int dict_size:
+    :param int sample_size: rows sampled for training, per kind
+    :param int max_sample_bytes: media samples are truncated to this many bytes
+    :param int chunk_size: rows per transaction
+    :param bool vacuum: run VACUUM afterwards, so that the file actually shrinks
+    :return: dict of kind to (stored bytes before, stored bytes after)
+    """
+    from . import db
+
+    _require()
+    result = dict()
+    for kind in kinds:
+        before = stored_bytes(kind)
+        first = not db.CompressionDict.select().where(db.CompressionDict.kind == kind).exists()
+        dict_data = train_dictionary(_raw_samples(kind, sample_size, max_sample_bytes), dict_size)
+        db.CompressionDict.update(active=False).where(db.CompressionDict.kind == kind).execute()
+        db.CompressionDict.create(kind=kind, data=dict_data, level=level)
+        registry.stale = True
+        _rewrite(kind, chunk_size, raw=first)
+        result[kind] = (before, stored_bytes(kind))
+
+    if vacuum:
+        db.database.execute_sql('VACUUM')
+
+    return result
+
+
+def decompress_collection(kinds=KINDS, chunk_size=500, vacuum=True):
+    """
+    Rewrite every row uncompressed and delete the dictionaries, e.g. before opening
+    the file with an older version of ankix.
+    :param tuple kinds:
+    :param int chunk_size:
+    :param bool vacuum:
+    :return:
+    """
+    from . import db
+
+    for kind in kinds:
+        if not db.CompressionDict.select().where(db.CompressionDict.kind == kind).exists():
+            continue
+
+        db.CompressionDict.update(active=False).where(db.CompressionDict.kind == kind).execute()
+        registry.stale = True
+        _rewrite(kind, chunk_size)
+        db.CompressionDict.delete().where(db.CompressionDict.kind == kind).execute()
+        registry.stale = True
+
+    if vacuum:
+        db.database.execute_sql('VACUUM')
+
+
+def _stored(model, data):
+    value = model.data.db_value(data)
+    if isinstance(value, pv.Node):  # uncompressed note, i.e. json(...) in SQL
+        value = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    return value
+
+
+def _rewrite(kind, chunk_size, raw=False):
+    """
+    :param bool raw: rows are known to be uncompressed, so read them as they are stored;
+                     a media file that is itself a zstd frame must not be mistaken for a compressed row
+    """
+    from . import db
+
+    model = db.Note if kind == 'note' else db.Media
+    last_id = 0
+    with tqdm(total=model.select().count(), desc=kind) as pbar:
+        while True:
+            db_query = model.select(model.id, model.data).where(model.id > last_id) \
+                .order_by(model.id).limit(chunk_size)
+            if raw:
+                rows = db.database.execute(db_query).fetchall()
+                if kind == 'note':
+                    rows = [(record_id, json.loads(data)) for record_id, data in rows]
+            else:
+                rows = list(db_query.tuples())
+            if not rows:
+                break
+
+            with db.database.atomic():
+                db.database.cursor().executemany(
+                    'UPDATE "{}" SET data = ? WHERE id = ?'.format(model._meta.table_name),
+                    [(_stored(model, data), record_id) for record_id, data in rows]
+                )
+
+            last_id = rows[-1][0]
+            pbar.update(len(rows))
+
+
+def stored_bytes(kind):
+    """
+    :param str kind: 'note' or 'media'
+    :return: total bytes of the data column, as stored
+    """
+    from . import db
+
+    model = db.Note if kind == 'note' else db.Media
+
+    return model.select(pv.fn.SUM(pv.fn.length(model.data.cast('BLOB')))).scalar() or 0
+
+
+def benchmark(sample=200, repeat=3):
+    """
+    File size against render latency of the open collection; run it before and after
+    compress_collection().
+    :param int sample: cards rendered
+    :param int repeat:
+    :return: dict
+    """
+    from . import db
+
+    card_ids = _sample_ids(db.Card, sample)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for db_card in db.Card.load_for_render(card_ids):
+            db_card.html
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'file_bytes': os.path.getsize(db.database.path),
+        'note_bytes': stored_bytes('note'),
+        'media_bytes': stored_bytes('media'),
+        'compressed': sorted(registry.active),
+        'ms_per_card': min(timings) / max(len(card_ids), 1) * 1000
+    }
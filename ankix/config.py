@@ -6,6 +6,8 @@ from .util import parse_srs
 class Config(dict):
     DEFAULT = {
         'markdown': True,
+        'media_url': None,  # e.g. '/media/' when served by ankix.server; None inlines data URIs
+        'max_image_px': None,  # render image derivatives (see ankix.derivatives) instead of originals
         'srs': [
             timedelta(minutes=10),  # 0
             timedelta(hours=1),     # 1
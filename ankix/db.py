@@ -3,20 +3,147 @@ from playhouse import sqlite_ext, signals
 from playhouse.shortcuts import model_to_dict
 
 from datetime import datetime, timedelta
-from pytimeparse.timeparse import timeparse
 import random
+import threading
+import atexit
+from array import array
 import sys
 import re
 import json
 import hashlib
-import magic
+import os
+from urllib.request import pathname2url
 
 from .config import config
 from .jupyter import HTML
-from .util import MediaType, parse_srs, do_markdown, build_base64
+from .util import MediaType, parse_srs, load_srs, do_markdown, build_base64, \
+    clear_markdown_cache, parse_cloze, render_cloze
 from .preview import TemplateMaker
+from .names import name_index, invalidate as invalidate_name_index, invalidate_all, HIERARCHY_SEP
+from .compress import registry as codecs, MAGIC as COMPRESSED_MAGIC
 
-database = sqlite_ext.SqliteDatabase(None)
+
+class ReadOnlyError(pv.PeeweeException):
+    pass
+
+
+class AnkixDatabase(sqlite_ext.SqliteDatabase):
+    """
+    SqliteDatabase with a read-only snapshot mode, for many concurrent reader processes:
+    the file is opened with mode=ro (and immutable=1, which skips locking entirely;
+    only use it if no other process writes to the file), memory-mapped, and any
+    write raises ReadOnlyError.
+    """
+    MMAP_SIZE = 1 << 30
+    READ_SQL = ('SELECT', 'WITH', 'EXPLAIN', 'PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+    path = None
+    readonly = False
+
+    def init(self, database, readonly=False, immutable=True, **kwargs):
+        self.path = database
+        self.readonly = readonly
+
+        if readonly and database is not None:
+            database = 'file:{}?mode=ro{}'.format(pathname2url(os.path.abspath(database)),
+                                                  '&immutable=1' if immutable else '')
+            kwargs['uri'] = True
+
+            pragmas = dict(kwargs.get('pragmas') or ())
+            pragmas.setdefault('mmap_size', self.MMAP_SIZE)
+            pragmas.setdefault('query_only', 1)
+            kwargs['pragmas'] = pragmas
+
+        super(AnkixDatabase, self).init(database, **kwargs)
+        invalidate_all()
+        codecs.stale = True
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if self.readonly and not sql.lstrip().upper().startswith(self.READ_SQL):
+            raise ReadOnlyError('{} is opened read-only; cannot execute: {}'.format(self.path, sql[:80]))
+
+        return super(AnkixDatabase, self).execute_sql(sql, *args, **kwargs)
+
+
+database = AnkixDatabase(None)
+
+
+def get_codecs():
+    """
+    :return: compress.registry, loaded from CompressionDict of the open database
+    """
+    if codecs.stale:
+        try:
+            codecs.load(CompressionDict.select(CompressionDict.kind, CompressionDict.data,
+                                               CompressionDict.level, CompressionDict.active)
+                        .order_by(CompressionDict.id).tuples())
+        except pv.OperationalError:
+            codecs.load([])
+
+    return codecs
+
+
+class CompressedJSONPath(sqlite_ext.JSONPath):
+    def __sql__(self, ctx):
+        if self._path and 'note' in get_codecs().kinds:
+            return ctx.sql(pv.fn.json_extract(pv.fn.ankix_json(self._field), self.path))
+
+        return super(CompressedJSONPath, self).__sql__(ctx)
+
+
+class CompressedJSONField(sqlite_ext.JSONField):
+    """
+    JSONField stored as a zstd-compressed blob when note compression is on (see ankix.compress).
+    Plain JSON text is read as before, so compressed and uncompressed rows can be mixed.
+    """
+    Path = CompressedJSONPath
+
+    def to_bytes(self, value):
+        return self._json_dumps(value).encode()
+
+    def db_value(self, value):
+        if value is not None and not isinstance(value, pv.Node) and get_codecs().enabled('note'):
+            c = codecs.compress('note', self.to_bytes(value))
+            if c is not None:
+                return c
+
+        return super(CompressedJSONField, self).db_value(value)
+
+    def python_value(self, value):
+        if isinstance(value, bytes):
+            value = get_codecs().decompress(value).decode()
+
+        return super(CompressedJSONField, self).python_value(value)
+
+
+class CompressedBlobField(pv.BlobField):
+    """
+    BlobField stored zstd-compressed when media compression is on and it pays off.
+    """
+
+    def db_value(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            # a file that is itself a zstd frame is always wrapped, so that it reads back unchanged
+            c = get_codecs().compress('media', value, force=value.startswith(COMPRESSED_MAGIC))
+            if c is not None:
+                value = c
+
+        return super(CompressedBlobField, self).db_value(value)
+
+    def python_value(self, value):
+        if value is not None and bytes(value[:4]) == COMPRESSED_MAGIC and 'media' in get_codecs().kinds:
+            return get_codecs().decompress(bytes(value))
+
+        return super(CompressedBlobField, self).python_value(value)
+
+
+@database.func('ankix_json')
+def _unpack_json(value):
+    if isinstance(value, bytes):
+        return get_codecs().decompress(value).decode()
+
+    return value
 
 
 class BaseModel(signals.Model):
@@ -35,6 +162,39 @@ class BaseModel(signals.Model):
         database = database
 
 
+SCHEMA_VERSION = '0.2.5'
+
+# rows per INSERT; 100 rows of the widest table stay under SQLite's 999 host parameters
+INSERT_BATCH_SIZE = 100
+
+
+class SchemaVersion(BaseModel):
+    """
+    Single row: the schema version of the file, and the migration checkpoint if a
+    migration was interrupted (see migration.do_migrate).
+    """
+    version = pv.TextField()
+    step = pv.TextField(null=True)
+    last_id = pv.IntegerField(null=True)
+
+
+class CompressionDict(BaseModel):
+    """
+    zstd dictionaries trained by compress.compress_collection(); the newest active one
+    of each kind compresses new rows. data is NULL for plain zstd without a dictionary.
+    """
+    kind = pv.TextField()  # 'note' or 'media'
+    data = pv.BlobField(null=True)
+    level = pv.IntegerField(default=3)
+    active = pv.BooleanField(default=True)
+    created = pv.DateTimeField(default=datetime.now)
+
+
+@signals.post_save(sender=CompressionDict)
+def compression_dict_post_save(model_class, instance, created):
+    codecs.stale = True
+
+
 class Settings(BaseModel):
     DEFAULT = config.to_db()
 
@@ -52,11 +212,7 @@ class Settings(BaseModel):
 
     @property
     def srs(self):
-        d = dict()
-        for i, s in enumerate(json.loads(str(self._srs))):
-            d[i] = timedelta(seconds=timeparse(s))
-
-        return d
+        return dict(enumerate(load_srs(str(self._srs))))
 
     @srs.setter
     def srs(self, value):
@@ -67,6 +223,8 @@ class Settings(BaseModel):
 @signals.post_save(sender=Settings)
 def auto_update_config(model_class, instance, created):
     config.update(model_class.to_dict())
+    clear_markdown_cache()
+    srs_table.stale = True
 
 
 class Tag(BaseModel):
@@ -84,26 +242,136 @@ class Tag(BaseModel):
 
 
 class Media(BaseModel):
+    """
+    One row per distinct content (h is the MD5 of data). Every file name pointing
+    to the same content is a MediaAlias, and refs counts the aliases.
+    """
     name = pv.TextField(unique=True)
     type_ = pv.TextField(default=MediaType.font)
-    data = pv.BlobField()
+    data = CompressedBlobField()
     h = pv.TextField(unique=True)
+    refs = pv.IntegerField(default=1)
+    # aliases
     # models (for css)
     # notes
 
     def __repr__(self):
         return f'<Media: "{self.name}">'
 
+    @classmethod
+    def add(cls, name, path, type_=None):
+        """
+        Add a media file by content. If the same bytes are already stored, only a new
+        name alias is recorded, and the file is only hashed, never read into memory.
+        :param str name:
+        :param str|Path path:
+        :param type_: MediaType, or None to sniff it with magic
+        :return: Media
+        :raise IntegrityError: if name already exists with different content
+        """
+        from .ingest import MediaIngest
+
+        media_id = MediaIngest(type_=type_, progress=False, strict=True).run([(name, path)])[name]
+
+        return cls.get_by_id(media_id)
+
+    @classmethod
+    def get_by_name(cls, name):
+        return cls.select().join(MediaAlias).where(MediaAlias.name == name).get()
+
+    @property
+    def names(self):
+        names = getattr(self, '_names', None)
+        if names is None:
+            names = [a.name for a in self.aliases]
+        if not names:
+            names = [self.name]
+
+        return names
+
+    def discard(self, name):
+        """
+        Remove one name alias; the blob itself is deleted with its last alias.
+        :param str name:
+        :return: True if the blob was deleted
+        """
+        with database.atomic():
+            MediaAlias.delete().where((MediaAlias.name == name) & (MediaAlias.media == self.id)).execute()
+            self.refs = MediaAlias.select().where(MediaAlias.media == self.id).count()
+            if self.refs == 0:
+                self.delete_instance(recursive=True)
+                return True
+
+            if self.name == name:
+                self.name = self.names[0]
+
+            self.save()
+
+        return False
+
     @property
     def src(self):
+        if self.data is None:  # left out by Card.load_for_render when media is served by URL
+            self.data = Media.select(Media.data).where(Media.id == self.id).get().data
+
         return build_base64(bytes(self.data))
 
+    @property
+    def url(self):
+        """
+        URL under config['media_url'] (see ankix.server), or a data URI if not set.
+        :return:
+        """
+        if config.get('media_url'):
+            return config['media_url'] + self.h
+
+        return self.src
+
+    @property
+    def may_be_image(self):
+        """
+        import_apkg stores every file as MediaType.font, so anything but audio may be an image;
+        scale_image decides by content.
+        """
+        return self.type_ != MediaType.audio
+
+    def scaled_url(self, max_px):
+        """
+        URL of the largest derivative of an image that fits in max_px (see ankix.derivatives),
+        or of the original if it already fits, or has no derivative yet.
+        :param int max_px:
+        :return:
+        """
+        if not self.may_be_image:
+            return self.url
+
+        derivatives = getattr(self, '_derivatives', None)
+        if derivatives is None:
+            derivatives = self._derivatives = dict()
+        if max_px not in derivatives:
+            derivatives[max_px] = MediaDerivative.pick([self.h], max_px).get(self.h)
+
+        db_derivative = derivatives[max_px]
+        if db_derivative is None or db_derivative.data is None:
+            return self.url
+
+        return db_derivative.url
+
     @property
     def html(self):
-        if self.type_ == MediaType.font:
-            return f'<img src="{self.src}" />'
+        return self.to_html()
+
+    def to_html(self, inline=False):
+        """
+        :param bool inline: use a data URI, whatever config['media_url'] and config['max_image_px'] are
+        """
+        url = self.src if inline else self.url
+        if self.may_be_image and config.get('max_image_px') and not inline:
+            return f'<img src="{self.scaled_url(config["max_image_px"])}" />'
+        elif self.type_ == MediaType.font:
+            return f'<img src="{url}" />'
         elif self.type_ == MediaType.audio:
-            return f'<audio controls src="{self.src}" />'
+            return f'<audio controls src="{url}" />'
         else:
             return f'<pre>{repr(self)}</pre>'
 
@@ -127,7 +395,69 @@ class Media(BaseModel):
 
 @signals.pre_save(sender=Media)
 def media_pre_save(model_class, instance, created):
-    instance.h = hashlib.md5(instance.data).hexdigest()
+    dirty = {f.name for f in instance.dirty_fields}
+    if not instance.h or ('data' in dirty and 'h' not in dirty):
+        instance.h = hashlib.md5(instance.data).hexdigest()
+
+
+class MediaAlias(BaseModel):
+    name = pv.TextField(unique=True)
+    media = pv.ForeignKeyField(Media, backref='aliases', on_delete='cascade')
+
+    def __repr__(self):
+        return f'<MediaAlias: "{self.name}">'
+
+
+class MediaDerivative(BaseModel):
+    """
+    Downscaled copy of an image Media (see ankix.derivatives), keyed by the original's h
+    and the maximum width/height in pixels. data is NULL if the original already fits,
+    or is not a still raster image.
+    """
+    media = pv.ForeignKeyField(Media, field='h', backref='derivatives', on_delete='cascade')
+    size = pv.IntegerField()
+    mime = pv.TextField(null=True)
+    data = pv.BlobField(null=True)
+
+    class Meta:
+        indexes = (
+            (('media_id', 'size'), True),
+        )
+
+    def __repr__(self):
+        return f'<MediaDerivative: {self.media_id} {self.size}px>'
+
+    @property
+    def url(self):
+        if config.get('media_url'):
+            return f'{config["media_url"]}{self.media_id}?px={self.size}'
+
+        return build_base64(bytes(self.data), mime=self.mime)
+
+    @classmethod
+    def pick(cls, hashes, max_px):
+        """
+        For each original, the largest derivative of at most max_px, else the smallest one.
+        Originals without any derivative are queued to the running derivatives pool, if any.
+        :param list hashes: Media.h
+        :param int max_px:
+        :return: dict of Media.h to MediaDerivative (data is NULL if the original fits),
+                 or None if there is no derivative yet
+        """
+        hashes = list(hashes)
+        result = dict.fromkeys(hashes)
+        for db_derivative in cls.select().where(cls.media.in_(hashes)).order_by(cls.size):
+            current = result[db_derivative.media_id]
+            if current is None or db_derivative.size <= max_px:
+                result[db_derivative.media_id] = db_derivative
+
+        missing = [h for h, db_derivative in result.items() if db_derivative is None]
+        if missing:
+            from . import derivatives
+
+            derivatives.request(missing)
+
+        return result
 
 
 class Model(BaseModel):
@@ -216,9 +546,9 @@ class Template(BaseModel):
     def search(cls, model_name=None, template_name=None, question=None, answer=None):
         db_query = cls.select()
         if model_name:
-            db_query = db_query.join(Model).where(Model.name.contains(model_name))
+            db_query = db_query.where(cls.model.in_(match_names(Model, model_name)))
         if template_name:
-            db_query = db_query.where(cls.name.contains(template_name))
+            db_query = db_query.where(cls.id.in_(match_names(cls, template_name)))
         if question:
             db_query = db_query.where(cls.question.contains(question))
         if answer:
@@ -281,11 +611,12 @@ class Deck(BaseModel):
 
 
 class Note(BaseModel):
-    data = sqlite_ext.JSONField()
+    data = CompressedJSONField()
     model = pv.ForeignKeyField(Model, backref='notes')
     media = pv.ManyToManyField(Media, backref='notes', on_delete='cascade')
     tags = pv.ManyToManyField(Tag, backref='notes', on_delete='cascade')
     h = pv.TextField(unique=True)
+    cloze = sqlite_ext.JSONField(null=True)  # see util.parse_cloze
 
     def mark(self, tag):
         Tag.get_or_create(name=tag)[0].notes.add(self)
@@ -299,6 +630,40 @@ class Note(BaseModel):
                 db_note.data[new_name] = db_note.data.pop(old_name)
                 db_note.save()
 
+    @staticmethod
+    def _get_model(model):
+        if isinstance(model, int) or (isinstance(model, str) and model.isdigit()):
+            return Model.get(id=int(model))
+        elif isinstance(model, Model):
+            return model
+        else:
+            return Model.get(name=model)
+
+    @staticmethod
+    def _get_deck(deck):
+        if isinstance(deck, int) or (isinstance(deck, str) and deck.isdigit()):
+            return Deck.get(id=int(deck))
+        elif isinstance(deck, Deck):
+            return deck
+        else:
+            return Deck.get_or_create(name=deck)[0]
+
+    @staticmethod
+    def _get_template(template, db_model):
+        if isinstance(template, int) or (isinstance(template, str) and template.isdigit()):
+            return Template.get(id=int(template))
+        elif isinstance(template, Template):
+            return template
+        else:
+            return Template.get(model_id=db_model.id, name=template)
+
+    @staticmethod
+    def _cloze_orders(db_template, cloze):
+        if '{{cloze:' in db_template.question:
+            return cloze['ords'] if cloze else []
+
+        return [None]
+
     @classmethod
     def add(cls, data, model, card_to_decks: dict, media: dict=None, tags: list=None):
         if media is None:
@@ -307,50 +672,30 @@ class Note(BaseModel):
             tags = list()
 
         with database.atomic():
-            if isinstance(model, int) or (isinstance(model, str) and model.isdigit()):
-                db_model = Model.get(id=int(model))
-            elif isinstance(model, Model):
-                db_model = model
-            else:
-                db_model = Model.get(name=model)
+            db_model = cls._get_model(model)
 
             db_note = cls.create(
                 data=data,
                 model_id=db_model.id
             )
 
-            for template, deck in card_to_decks.items():
-                if isinstance(deck, int) or (isinstance(deck, str) and deck.isdigit()):
-                    db_deck = Deck.get(id=int(deck))
-                elif isinstance(deck, Deck):
-                    db_deck = deck
-                else:
-                    db_deck = Deck.get_or_create(name=deck)[0]
-
-                if isinstance(template, int) or (isinstance(template, str) and template.isdigit()):
-                    db_template = Template.get(id=int(template))
-                elif isinstance(template, Template):
-                    db_template = template
-                else:
-                    db_template = Template.get(model_id=db_model.id, name=template)
-
-                Card.create(
-                    note_id=db_note.id,
-                    deck_id=db_deck.id,
-                    template_id=db_template.id
-                )
+            # link media first, so that card_pre_save hashes the question with it
+            if media:
+                from .ingest import ingest_media
+
+                for media_id in set(ingest_media(media.items(), progress=False, strict=True).values()):
+                    NoteMedia.create(note=db_note.id, media=media_id)
 
-            for media_name, media_path in media.items():
-                type_ = {
-                    'audio': MediaType.audio,
-                    'font': MediaType.font
-                }.get(magic.from_file(media_path, mime=True).split('/')[0], MediaType.image)
-
-                with open(media_path, 'rb') as f:
-                    Media.create(
-                        name=media_name,
-                        data=f.read(),
-                        type_=type_
+            for template, deck in card_to_decks.items():
+                db_deck = cls._get_deck(deck)
+                db_template = cls._get_template(template, db_model)
+
+                for cloze_order in cls._cloze_orders(db_template, db_note.cloze):
+                    Card.create(
+                        note_id=db_note.id,
+                        deck_id=db_deck.id,
+                        template_id=db_template.id,
+                        cloze_order=cloze_order
                     )
 
             for tag_name in tags:
@@ -359,43 +704,173 @@ class Note(BaseModel):
         return db_note
 
     @classmethod
-    def search(cls, model_name=None, deck_name=None, tags=None, data=None, **kwargs):
+    def add_many(cls, records, model, card_to_decks: dict, tags: list=None,
+                 chunk_size=500, skip_duplicates=False):
+        """
+        Bulk version of Note.add. Model, decks, templates and tags are resolved once,
+        and notes, cards and tags are written with batched inserts, one transaction per chunk.
+
+        :param records: iterable of dict (note data)
+        :param model: same as Note.add
+        :param dict card_to_decks: same as Note.add
+        :param list tags: tag names added to every note
+        :param int chunk_size: notes per transaction
+        :param bool skip_duplicates: skip notes whose data already exists, instead of raising IntegrityError
+        :return: number of notes added
+        """
+        if tags is None:
+            tags = list()
+
+        with database.atomic():
+            db_model = cls._get_model(model)
+            db_fonts = list(db_model.fonts)
+            template_decks = [(cls._get_template(template, db_model), cls._get_deck(deck))
+                              for template, deck in card_to_decks.items()]
+            tag_ids = [Tag.get_or_create(name=tag_name)[0].id for tag_name in tags]
+
+        for db_template, _ in template_decks:
+            db_template.model = db_model
+
+        n = 0
+        chunk = []
+        for data in records:
+            chunk.append(data)
+            if len(chunk) >= chunk_size:
+                n += cls._add_chunk(chunk, db_model, db_fonts, template_decks, tag_ids, skip_duplicates)
+                chunk = []
+
+        if chunk:
+            n += cls._add_chunk(chunk, db_model, db_fonts, template_decks, tag_ids, skip_duplicates)
+
+        return n
+
+    @classmethod
+    def _add_chunk(cls, chunk, db_model, db_fonts, template_decks, tag_ids, skip_duplicates):
+        db_notes = dict()
+        for data in chunk:
+            d = clean_note_data(data)
+            db_note = cls(data=d, model=db_model, h=note_hash(d), cloze=parse_cloze(d))
+            if db_note.h in db_notes:
+                if skip_duplicates:
+                    continue
+                raise pv.IntegrityError('UNIQUE constraint failed: note.h')
+
+            db_notes[db_note.h] = db_note
+
+        with database.atomic():
+            if skip_duplicates:
+                for h, in cls.select(cls.h).where(cls.h.in_(list(db_notes))).tuples():
+                    del db_notes[h]
+
+            if not db_notes:
+                return 0
+
+            note_rows = [{
+                'data': db_note.data,
+                'model': db_model.id,
+                'h': db_note.h,
+                'cloze': db_note.cloze
+            } for db_note in db_notes.values()]
+            for row_batch in pv.chunked(note_rows, INSERT_BATCH_SIZE):
+                cls.insert_many(row_batch).execute()
+
+            for h, note_id in cls.select(cls.h, cls.id).where(cls.h.in_(list(db_notes))).tuples():
+                db_notes[h].id = note_id
+
+            card_rows = []
+            for db_note in db_notes.values():
+                for db_template, db_deck in template_decks:
+                    for cloze_order in cls._cloze_orders(db_template, db_note.cloze):
+                        db_card = Card(note=db_note, template=db_template, deck=db_deck, cloze_order=cloze_order)
+                        db_card._loaded = {'media': [], 'fonts': db_fonts, 'tags': []}
+                        card_rows.append({
+                            'note': db_note.id,
+                            'deck': db_deck.id,
+                            'template': db_template.id,
+                            'cloze_order': cloze_order,
+                            'h': card_hash(db_card)
+                        })
+            for row_batch in pv.chunked(card_rows, INSERT_BATCH_SIZE):
+                Card.insert_many(row_batch).execute()
+
+            tag_rows = [{'note': db_note.id, 'tag': tag_id}
+                        for db_note in db_notes.values() for tag_id in tag_ids]
+            for row_batch in pv.chunked(tag_rows, INSERT_BATCH_SIZE):
+                NoteTag.insert_many(row_batch).execute()
+
+        return len(db_notes)
+
+    @classmethod
+    def search(cls, model_name=None, deck_name=None, tags=None, data=None, deck_path=None, **kwargs):
         db_query = cls.select()
         if deck_name:
-            db_query = db_query \
-                .join(Card).join(Deck) \
-                .where(Deck.name.contains(deck_name))
+            db_query = db_query.where(cls.id.in_(
+                Card.select(Card.note).where(Card.deck.in_(match_names(Deck, deck_name)))))
+        if deck_path:
+            db_query = db_query.where(cls.id.in_(
+                Card.select(Card.note).where(Card.deck.in_(match_deck_path(deck_path)))))
 
         db_query = cls._build_query(db_query, model_name=model_name, tags=tags, data=data, **kwargs)
 
         return db_query
 
     @classmethod
-    def _build_query(cls, db_query, model_name=None, tags=None, data=None, **kwargs):
-        if data is None:
-            data = dict()
-        data.update(kwargs)
+    def _build_query(cls, db_query, note_id=None, model_name=None, tags=None, data=None, **kwargs):
+        """
+        Filter db_query by note attributes.
+        :param note_id: column of db_query holding the note id; Note.id by default, Card.note for cards
+        """
+        if note_id is None:
+            note_id = cls.id
+        data = dict(data or dict(), **kwargs)
 
-        db_query = db_query.switch(cls)
+        def _where(db_query, *expressions):
+            if note_id is cls.id:
+                return db_query.where(*expressions)
+
+            return db_query.where(note_id.in_(cls.select(cls.id).where(*expressions)))
 
         if data:
-            for k, v in data.items():
-                db_query = db_query.where(cls.data[k].contains(v))
+            db_query = _where(db_query, *[cls.data[k].contains(v) for k, v in data.items()])
         if model_name:
-            db_query = db_query \
-                .join(Model) \
-                .where(Model.name.contains(model_name))
+            db_query = _where(db_query, cls.model.in_(match_names(Model, model_name)))
         if tags:
-            db_query = db_query\
-                .join(NoteTag).join(Tag)\
-                .where(~Tag.name.not_in(tags))
+            db_query = db_query.where(note_id.in_(
+                NoteTag.select(NoteTag.note).where(NoteTag.tag.in_(match_tags(tags)))))
 
         return db_query
 
+    @classmethod
+    def get_viewer(cls, records, max_image_px=None):
+        records = list(records)
+        note_cards = dict()
+        card_ids = Card.select(Card.id).where(Card.note.in_([r.id for r in records]))
+        for db_card in Card.load_for_render((c.id for c in card_ids), max_image_px=max_image_px):
+            note_cards.setdefault(db_card.note_id, []).append(db_card)
+
+        note_tags = dict()
+        for r in NoteTag.select(NoteTag.note, Tag.name).join(Tag).where(NoteTag.note.in_([r.id for r in records])):
+            note_tags.setdefault(r.note_id, []).append(r.tag.name)
+
+        models = {m.id: m for m in Model.select().where(Model.id.in_(list(set(r.model_id for r in records))))}
+
+        for r in records:
+            r._loaded_cards = note_cards.get(r.id, [])
+            r._loaded_tags = note_tags.get(r.id, [])
+            r.model = models[r.model_id]
+
+        return super(Note, cls).get_viewer(records)
+
     def to_viewer(self):
+        db_cards = getattr(self, '_loaded_cards', None)
+        if db_cards is None:
+            db_cards = self.cards
+
         d = model_to_dict(self)
-        d['cards'] = '<br/>'.join(c.html for c in self.cards)
-        d['tags'] = [t.name for t in self.tags]
+        d['cards'] = '<br/>'.join(c.html for c in db_cards)
+        d['tags'] = getattr(self, '_loaded_tags', None)
+        if d['tags'] is None:
+            d['tags'] = [t.name for t in self.tags]
 
         return d
 
@@ -413,10 +888,9 @@ NoteTag = Note.tags.get_through_model()
 NoteMedia = Note.media.get_through_model()
 
 
-@signals.pre_save(sender=Note)
-def note_pre_save(model_class, instance, created):
+def clean_note_data(data):
     d = dict()
-    for k, v in instance.data.items():
+    for k, v in data.items():
         if v in {None, ''}:
             continue
 
@@ -425,8 +899,20 @@ def note_pre_save(model_class, instance, created):
         else:
             raise ValueError('Field {} is not string: {}'.format(k, v))
 
+    return d
+
+
+def note_hash(d):
+    return hashlib.md5(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+
+@signals.pre_save(sender=Note)
+def note_pre_save(model_class, instance, created):
+    d = clean_note_data(instance.data)
+
     instance.data = d
-    instance.h = hashlib.md5(json.dumps(d, sort_keys=True).encode()).hexdigest()
+    instance.h = note_hash(d)
+    instance.cloze = parse_cloze(d)
 
 
 class Card(BaseModel):
@@ -438,6 +924,8 @@ class Card(BaseModel):
     next_review = pv.DateTimeField(null=True)
     h = pv.TextField(unique=True)
 
+    max_image_px = None  # see load_for_render
+
     @property
     def css(self):
         return self.template.model.css
@@ -460,25 +948,123 @@ class Card(BaseModel):
         return db_card
 
     @classmethod
-    def search(cls, template_name=None, model_name=None, deck_name=None, tags=None, data=None, **kwargs):
+    def search(cls, template_name=None, model_name=None, deck_name=None, tags=None, data=None,
+               deck_path=None, **kwargs):
+        """
+        Name filters are substring matches, resolved to ids with the in-memory NameIndex
+        before the card query runs.
+        :param str deck_path: a deck and all of its subdecks, e.g. 'Parent' matches 'Parent::Child'
+        """
         db_query = cls.select()
         if template_name:
-            db_query = db_query.join(Template).where(Template.name.contains(template_name))
+            db_query = db_query.where(cls.template.in_(match_names(Template, template_name)))
+        if model_name:
+            db_query = db_query.where(cls.template.in_(
+                Template.select(Template.id).where(Template.model.in_(match_names(Model, model_name)))))
         if deck_name:
-            db_query = db_query.switch(cls) \
-                .join(Deck) \
-                .where(Deck.name.contains(deck_name))
+            db_query = db_query.where(cls.deck.in_(match_names(Deck, deck_name)))
+        if deck_path:
+            db_query = db_query.where(cls.deck.in_(match_deck_path(deck_path)))
 
-        db_query = Note._build_query(db_query, model_name=model_name, tags=tags, data=data, **kwargs)
+        db_query = Note._build_query(db_query, note_id=cls.note, tags=tags, data=data, **kwargs)
 
         return db_query
 
+    @classmethod
+    def load_for_render(cls, card_ids, chunk_size=500, max_image_px=None):
+        """
+        Fetch cards together with their note, deck, template, model, fonts, media and tags,
+        in a constant number of queries per chunk, so that rendering them makes no further queries.
+        :param list card_ids:
+        :param int chunk_size: ids per query, to stay under SQLite's variable limit
+        :param int max_image_px: render image derivatives of at most this size (see ankix.derivatives);
+                                 defaults to config['max_image_px']
+        :return: list of Card, in the order of card_ids
+        """
+        if max_image_px is None:
+            max_image_px = config.get('max_image_px')
+
+        card_ids = list(card_ids)
+        db_cards = dict()
+        for i in range(0, len(card_ids), chunk_size):
+            db_cards.update(cls._load_chunk(card_ids[i:i + chunk_size], max_image_px))
+
+        return [db_cards[card_id] for card_id in card_ids if card_id in db_cards]
+
+    @classmethod
+    def _load_chunk(cls, card_ids, max_image_px=None):
+        db_cards = {c.id: c for c in cls.select(cls, Note, Deck, Template, Model)
+                    .join(Note).switch(cls)
+                    .join(Deck).switch(cls)
+                    .join(Template).join(Model)
+                    .where(cls.id.in_(card_ids))}
+        note_ids = set(c.note_id for c in db_cards.values())
+        model_ids = set(c.template.model_id for c in db_cards.values())
+
+        # blobs are only needed to inline data URIs; with config['media_url'], Media.src loads them on demand
+        media_columns = [Media.id, Media.name, Media.type_, Media.h, Media.refs]
+        if not config.get('media_url'):
+            media_columns.append(Media.data)
+
+        media = dict()
+        note_media = dict()
+        for r in NoteMedia.select(NoteMedia.note, *media_columns).join(Media).where(NoteMedia.note.in_(note_ids)):
+            note_media.setdefault(r.note_id, []).append(media.setdefault(r.media.id, r.media))
+
+        model_fonts = dict()
+        for r in ModelFont.select(ModelFont.model, *media_columns).join(Media).where(ModelFont.model.in_(model_ids)):
+            model_fonts.setdefault(r.model_id, []).append(media.setdefault(r.media.id, r.media))
+
+        for db_media in media.values():
+            db_media._names = []
+        for r in MediaAlias.select(MediaAlias.name, MediaAlias.media).where(MediaAlias.media.in_(list(media))):
+            media[r.media_id]._names.append(r.name)
+
+        if max_image_px:
+            images = [m for m in media.values() if m.may_be_image]
+            for db_media, db_derivative in zip(images, MediaDerivative.pick([m.h for m in images], max_image_px)
+                                               .values()):
+                db_media._derivatives = {max_image_px: db_derivative}
+
+        note_tags = dict()
+        for r in NoteTag.select(NoteTag.note, Tag.name).join(Tag).where(NoteTag.note.in_(note_ids)):
+            note_tags.setdefault(r.note_id, []).append(r.tag.name)
+
+        for db_card in db_cards.values():
+            if db_card.note.model_id == db_card.template.model_id:
+                db_card.note.model = db_card.template.model
+
+            db_card._loaded = {
+                'media': note_media.get(db_card.note_id, []),
+                'fonts': model_fonts.get(db_card.template.model_id, []),
+                'tags': note_tags.get(db_card.note_id, [])
+            }
+            db_card.max_image_px = max_image_px
+
+        return db_cards
+
+    def _loaded_or(self, key, default):
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            return default()
+
+        return loaded[key]
+
+    @classmethod
+    def get_viewer(cls, records, max_image_px=None):
+        """
+        :param records: Card query or list of Card
+        :param int max_image_px: e.g. 256, to preview downscaled images (see ankix.derivatives)
+        """
+        return super(Card, cls).get_viewer(cls.load_for_render((r.id for r in records), max_image_px=max_image_px))
+
     def to_viewer(self):
+        question = self.question
         d = model_to_dict(self)
         d.update({
-            'question': str(self.question),
-            'answer': str(self.answer),
-            'tags': [t.name for t in self.note.tags]
+            'question': str(question),
+            'answer': str(self._render_answer(question.raw)),
+            'tags': self._loaded_or('tags', lambda: [t.name for t in self.note.tags])
         })
 
         return d
@@ -504,49 +1090,63 @@ class Card(BaseModel):
 
         html = re.sub(r'{{#([^}]+)}}(.*){{/\1}}', _sub, html, flags=re.DOTALL)
 
+        cloze_fields = dict()
+        if self.cloze_order is not None:
+            cloze = self.note.cloze
+            if cloze is None:
+                cloze = parse_cloze(self.note.data)
+            if cloze is not None:
+                cloze_fields = cloze['fields']
+
+        hidden = self.cloze_order if is_question else None
         for k, v in self.note.data.items():
-            html = html.replace('{{%s}}' % k, do_markdown(str(v)))
-            html = html.replace('{{cloze:%s}}' % k, do_markdown(str(v)))
-            if self.cloze_order is not None:
-                if is_question:
-                    html = re.sub(r'{{c%d::([^}]+)}}' % self.cloze_order,
-                                  '[...]', html)
+            if k in cloze_fields:
+                v = render_cloze(cloze_fields[k], hidden)
 
-                html = re.sub(r'{{c\d+::([^}]+)}}',
-                              '\g<1>', html)
+            v = do_markdown(str(v))
+            html = html.replace('{{%s}}' % k, v)
+            html = html.replace('{{cloze:%s}}' % k, v)
 
         html = re.sub('{{[^}]+}}', '', html)
 
         return html
 
-    @property
-    def question(self):
-        html = self._pre_render(self.template.question, is_question=True)
-
+    def _to_html(self, html, inline_media=False):
         return HTML(
             html,
-            media=self.note.media,
-            model=self.template.model
+            media=self._loaded_or('media', lambda: self.note.media),
+            model=self.template.model,
+            fonts=self._loaded_or('fonts', lambda: None),
+            max_image_px=self.max_image_px,
+            inline_media=inline_media
         )
 
+    @property
+    def question(self):
+        return self._to_html(self._pre_render(self.template.question, is_question=True))
+
     @property
     def answer(self):
+        return self._render_answer(self.question.raw)
+
+    def _render_answer(self, front_side):
         html = self._pre_render(self.template.answer, is_question=False)
-        html = html.replace('{{FrontSide}}', self.question.raw)
+        html = html.replace('{{FrontSide}}', front_side)
 
-        return HTML(
-            html,
-            media=self.note.media,
-            model=self.template.model
-        )
+        return self._to_html(html)
 
     @property
     def html(self):
+        question = self.question
+
+        return self._html(question, self._render_answer(question.raw))
+
+    def _html(self, question, answer):
         return TemplateMaker(
             name=self.template.name,
-            question=self.question.raw,
-            answer=self.answer.raw,
-            css=self.question.raw_css,
+            question=question.raw,
+            answer=answer.raw,
+            css=question.raw_css,
             _id=self.id
         ).html
 
@@ -565,48 +1165,339 @@ class Card(BaseModel):
     def unmark(self, name='marked'):
         self.note.unmark(name)
 
-    def right(self):
-        if not self.srs_level:
-            self.srs_level = 1
-        else:
-            self.srs_level = self.srs_level + 1
+    def right(self, save=True, response_time=None):
+        prev_level = self.srs_level
+        self.srs_level, self.next_review = srs_right(self.srs_level)
+        if save:
+            self.save()
 
-        self.next_review = (datetime.now()
-                            + config['srs'].get(int(self.srs_level), timedelta(weeks=4)))
-        self.save()
+        Review.log(self, Review.RIGHT, prev_level, response_time)
 
     correct = next_srs = right
 
-    def wrong(self, duration=timedelta(minutes=1)):
-        if self.srs_level and self.srs_level > 1:
-            self.srs_level = self.srs_level - 1
+    def wrong(self, duration=timedelta(minutes=1), save=True, response_time=None):
+        prev_level = self.srs_level
+        self.srs_level = srs_wrong(self.srs_level)
+
+        self.bury(duration, save=save)
 
-        self.bury(duration)
+        Review.log(self, Review.WRONG, prev_level, response_time)
 
     incorrect = previous_srs = wrong
 
-    def bury(self, duration=timedelta(hours=4)):
+    def bury(self, duration=timedelta(hours=4), save=True):
         self.next_review = datetime.now() + duration
-        self.save()
+        if save:
+            self.save()
+
+    RESCHEDULE_POLICIES = ('last_review', 'now')
+
+    @classmethod
+    def reschedule(cls, deck=None, policy='last_review', chunk_size=100000):
+        """
+        Recompute next_review of every scheduled card (srs_level is not null) from its srs_level
+        and the current config['srs'] ladder, e.g. after changing Settings.srs, which otherwise
+        only affects later right() calls. Runs in SQLite, see reschedule_rows.
+        Review state of ankix.learners lives in its own database; use Learner.reschedule for it.
+        :param deck: Deck, or a deck name together with its subdecks (like deck_path in Card.search);
+                     defaults to every card
+        :param str policy: 'last_review' -- time of the card's last Review (now if it has none) plus
+                           the interval of its level, i.e. as if the new ladder had always been used;
+                           'now' -- now plus the interval
+        :param int chunk_size:
+        :return: number of cards rescheduled
+        """
+        if policy not in cls.RESCHEDULE_POLICIES:
+            raise ValueError('policy must be one of {}'.format(cls.RESCHEDULE_POLICIES))
+        if database.readonly:
+            raise ReadOnlyError('{} is opened read-only; cannot reschedule'.format(database.path))
+
+        where = ''
+        if deck is not None:
+            deck_ids = [deck.id] if isinstance(deck, Deck) else name_index(Deck).subtree(deck)
+            if not deck_ids:
+                return 0
+            where = ' AND card.deck_id IN ({})'.format(','.join(str(int(i)) for i in deck_ids))
+
+        if policy == 'last_review':
+            Review.flush()
+            base = 'coalesce((SELECT max(r.timestamp) FROM review AS r WHERE r.card_id = card.id), ?)'
+        else:
+            base = '?'
+
+        return reschedule_rows(database, 'card', base, where, chunk_size=chunk_size)
+
+    @classmethod
+    def shuffled_ids(cls, db_query):
+        """
+        Read only the card ids of a query, as a shuffled array('q') (8 bytes per card),
+        without building a model instance per row.
+        :param db_query: a Card query without to-many joins, e.g. from Card.search
+        :return: array
+        """
+        card_ids = array('q', (r[0] for r in db_query.select(cls.id).tuples().iterator()))
+        random.shuffle(card_ids)
+
+        return card_ids
+
+    @classmethod
+    def iter_shuffled(cls, db_query, batch_size=50):
+        """
+        Iterate a Card query in random order, hydrating only batch_size cards at a time.
+        :param db_query:
+        :param int batch_size:
+        :return: generator of Card
+        """
+        card_ids = cls.shuffled_ids(db_query)
+        for i in range(0, len(card_ids), batch_size):
+            yield from cls.load_for_render(card_ids[i:i + batch_size])
 
     @classmethod
-    def iter_quiz(cls, template_name=None, model_name=None, deck_name=None, tags=None):
-        db_cards = list(cls.search(
+    def iter_quiz(cls, template_name=None, model_name=None, deck_name=None, tags=None, deck_path=None,
+                  batch_size=50):
+        return cls.iter_shuffled(cls.search(
             template_name=template_name,
             model_name=model_name,
             deck_name=deck_name,
-            tags=tags
-        ))
-        random.shuffle(db_cards)
-
-        return iter(db_cards)
+            tags=tags,
+            deck_path=deck_path
+        ), batch_size=batch_size)
 
     iter_due = iter_quiz
 
 
+class SrsTable:
+    """
+    config['srs'] compiled once to a tuple of intervals by srs level; rebuilt when Settings
+    is saved (see auto_update_config) or config['srs'] is replaced.
+    """
+    MAX_INTERVAL = timedelta(weeks=4)  # levels past the end of the ladder
+
+    def __init__(self):
+        self.stale = True
+        self.intervals = ()
+        self._source = None
+
+    def refresh(self):
+        srs = config.get('srs') or config.DEFAULT['srs']
+        if not self.stale and srs is self._source:
+            return self
+
+        if isinstance(srs, dict):  # as read from Settings
+            self.intervals = tuple(srs.get(k, self.MAX_INTERVAL) for k in range(max(srs, default=-1) + 1))
+        else:
+            self.intervals = tuple(srs)
+        self._source = srs
+        self.stale = False
+
+        return self
+
+    def interval(self, level):
+        """
+        :param int level:
+        :return: timedelta
+        """
+        level = int(level)
+        if 0 <= level < len(self.intervals):
+            return self.intervals[level]
+
+        return self.MAX_INTERVAL
+
+    def seconds(self):
+        """
+        :return: list of (level, seconds), ending with len(intervals) for MAX_INTERVAL
+        """
+        return [(level, td.total_seconds()) for level, td in
+                enumerate(self.intervals + (self.MAX_INTERVAL,))]
+
+
+srs_table = SrsTable()
+
+
+def reschedule_rows(database_, table, base, where='', params=(), chunk_size=100000):
+    """
+    Set next_review to base plus the config['srs'] interval of srs_level, for every row of table
+    whose srs_level is not null, with UPDATE statements on a temporary table of intervals by level.
+    Chunks are the next chunk_size rowids (not rowid ranges, which may be sparse, e.g. Anki card ids
+    are epoch milliseconds), one transaction each.
+    :param database_: database of table
+    :param str table: e.g. 'card', with srs_level and next_review columns
+    :param str base: SQL expression of the time to add the interval to, with one parameter for now
+    :param str where: extra filter, e.g. ' AND card.deck_id IN (1, 2)'
+    :param tuple params: parameters of where
+    :param int chunk_size:
+    :return: number of rows updated
+    """
+    intervals = srs_table.refresh().seconds()
+    bound_sql = ('SELECT max(rowid) FROM (SELECT rowid FROM {0} WHERE rowid > ? AND srs_level IS NOT NULL{1} '
+                 'ORDER BY rowid LIMIT ?)').format(table, where)
+    update_sql = ("UPDATE {0} SET next_review = strftime('%Y-%m-%d %H:%M:%f', {1}, '+' || "
+                  "(SELECT i.seconds FROM temp.reschedule_interval AS i WHERE i.level = min({0}.srs_level, ?)) "
+                  "|| ' seconds') "
+                  "WHERE rowid > ? AND rowid <= ? AND srs_level IS NOT NULL{2}").format(table, base, where)
+
+    database_.execute_sql('CREATE TEMP TABLE IF NOT EXISTS reschedule_interval '
+                          '(level INTEGER PRIMARY KEY, seconds REAL)')
+    try:
+        with database_.atomic():
+            database_.execute_sql('DELETE FROM temp.reschedule_interval')
+            database_.cursor().executemany('INSERT INTO temp.reschedule_interval VALUES (?, ?)', intervals)
+
+        now = str(datetime.now())
+        last_id = -1 << 63
+        n = 0
+        while True:
+            with database_.atomic():
+                bound = database_.execute_sql(bound_sql, (last_id,) + tuple(params) + (chunk_size,)).fetchone()[0]
+                if bound is None:
+                    break
+
+                n += database_.execute_sql(update_sql, (now, len(intervals) - 1, last_id, bound) + tuple(params)).rowcount
+                last_id = bound
+    finally:
+        database_.execute_sql('DROP TABLE IF EXISTS temp.reschedule_interval')
+
+    return n
+
+
+def srs_right(level):
+    """
+    :param int level: srs_level before a right answer
+    :return: (new level, next review)
+    """
+    level = level + 1 if level else 1
+
+    return level, datetime.now() + srs_table.refresh().interval(level)
+
+
+def srs_wrong(level):
+    """
+    :param int level: srs_level before a wrong answer
+    :return: new level
+    """
+    if level and level > 1:
+        return level - 1
+
+    return level
+
+
+def card_hash(db_card):
+    """
+    md5 of the question with media inlined as data URIs, so that it doesn't depend on
+    config['media_url'] or config['max_image_px'] (e.g. while ankix.server runs)
+    """
+    question = db_card._to_html(db_card._pre_render(db_card.template.question, is_question=True), inline_media=True)
+
+    return hashlib.md5(question.raw.encode()).hexdigest()
+
+
 @signals.pre_save(sender=Card)
 def card_pre_save(model_class, instance, created):
-    instance.h = hashlib.md5(instance.question.raw.encode()).hexdigest()
+    instance.h = card_hash(instance)
+
+
+class Review(BaseModel):
+    """
+    Append-only review history. Rows are buffered in memory and inserted in batches
+    of BATCH_SIZE; call Review.flush() to write them immediately (also done at exit).
+    """
+    WRONG = 0
+    RIGHT = 1
+    BATCH_SIZE = 500
+
+    card = pv.ForeignKeyField(Card, backref='reviews', on_delete='cascade')
+    timestamp = pv.DateTimeField(default=datetime.now, index=True)
+    grade = pv.IntegerField()
+    prev_level = pv.IntegerField(default=0)
+    new_level = pv.IntegerField(default=0)
+    response_time = pv.FloatField(null=True)  # seconds
+
+    _buffer = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def log(cls, db_card, grade, prev_level, response_time=None):
+        with cls._lock:
+            cls._buffer.append({
+                'card': db_card.id,
+                'timestamp': datetime.now(),
+                'grade': grade,
+                'prev_level': prev_level or 0,
+                'new_level': db_card.srs_level or 0,
+                'response_time': response_time
+            })
+            if len(cls._buffer) < cls.BATCH_SIZE:
+                return
+
+            rows, cls._buffer[:] = list(cls._buffer), []
+
+        cls._insert(rows)
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            rows, cls._buffer[:] = list(cls._buffer), []
+
+        cls._insert(rows)
+
+    @classmethod
+    def _insert(cls, rows):
+        if rows:
+            with database.atomic():
+                for row_batch in pv.chunked(rows, INSERT_BATCH_SIZE):
+                    cls.insert_many(row_batch).execute()
+
+    def __repr__(self):
+        return f'<Review: {self.card_id} {self.grade}>'
+
+
+@atexit.register
+def _flush_reviews():
+    if database.database is not None and Review._buffer:
+        try:
+            Review.flush()
+        except pv.PeeweeException:
+            pass
+
+
+MAX_IN_IDS = 500
+
+
+def match_names(model, name):
+    """
+    Ids of model whose name contains name (case-insensitive), from the in-memory NameIndex.
+    :return: list of ids, or a subquery if there are too many to pass as SQL parameters
+    """
+    ids = name_index(model).contains(name)
+    if len(ids) > MAX_IN_IDS:
+        return model.select(model.id).where(model.name.contains(name))
+
+    return list(ids)
+
+
+def match_deck_path(path):
+    ids = name_index(Deck).subtree(path)
+    if len(ids) > MAX_IN_IDS:
+        return Deck.select(Deck.id).where((Deck.name == path) | Deck.name.startswith(path + HIERARCHY_SEP))
+
+    return list(ids)
+
+
+def match_tags(tags):
+    ids = name_index(Tag).exact(tags)
+    if len(ids) > MAX_IN_IDS:
+        return Tag.select(Tag.id).where(Tag.name.in_(tags))
+
+    return list(ids)
+
+
+def _invalidate_name_index(model_class, instance, created=None):
+    invalidate_name_index(model_class)
+
+
+for _model in (Deck, Model, Template, Tag):
+    signals.post_save.connect(_invalidate_name_index, sender=_model)
+    signals.post_delete.connect(_invalidate_name_index, sender=_model)
 
 
 def create_all_tables():
@@ -0,0 +1,236 @@
+"""
+Downscaled copies of image Media for previews (`pip install ankix[images]`).
+
+Derivatives are keyed by Media.h and a maximum width/height in pixels, and stored in
+db.MediaDerivative. Rendering with max_image_px picks the largest derivative that fits,
+and falls back to the original while a derivative is missing.
+
+>>> from ankix import derivatives
+>>> pool = derivatives.start(sizes=(256, 1024))  # fills missing derivatives in the background
+>>> Card.get_viewer(records, max_image_px=256)
+>>> derivatives.stop()
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+import queue
+import io
+import peewee as pv
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .util import MediaType
+from . import db
+
+SIZES = (256, 1024)
+FORMAT = 'WEBP'
+
+
+def _require():
+    if Image is None:
+        raise ImportError('Pillow is required for image derivatives: pip install ankix[images]')
+
+
+def scale_image(data, size, format_=FORMAT, quality=80):
+    """
+    :param bytes data: original image
+    :param int size: maximum width and height, in pixels
+    :param str format_: PIL format of the derivative
+    :param int quality:
+    :return: (bytes, mime), or None if data is not a still raster image, or already fits in size
+    """
+    _require()
+    try:
+        im = Image.open(io.BytesIO(data))
+        if getattr(im, 'n_frames', 1) > 1 or max(im.size) <= size:
+            return None
+
+        im.draft('RGB', (size, size))  # JPEG only: decode at a reduced scale
+        im.thumbnail((size, size), Image.LANCZOS)
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if 'transparency' in im.info or 'A' in im.getbands() else 'RGB')
+
+        out = io.BytesIO()
+        im.save(out, format_, quality=quality)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    b = out.getvalue()
+    if len(b) >= len(data):
+        return None
+
+    return b, Image.MIME[format_.upper()]
+
+
+class DerivativePool:
+    """
+    Worker threads decode and scale images, and one writer thread inserts the
+    derivatives in batches, so that the caller never waits for it.
+    """
+
+    def __init__(self, sizes=SIZES, workers=4, batch_size=64, format_=FORMAT, quality=80):
+        """
+
+        :param tuple sizes: maximum width/height of each derivative
+        :param int workers: scaling threads
+        :param int batch_size: originals per insert
+        :param str format_: PIL format, e.g. 'WEBP', 'JPEG'
+        :param int quality:
+        """
+        _require()
+        if db.database.readonly:
+            raise db.ReadOnlyError('{} is opened read-only; cannot store derivatives'.format(db.database.path))
+
+        self.sizes = tuple(sorted(sizes))
+        self.batch_size = batch_size
+        self.format_ = format_
+        self.quality = quality
+
+        self.n_done = 0
+        self._pending = set()
+        self._cond = threading.Condition()
+        self._results = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __repr__(self):
+        return f'<DerivativePool: {self.n_done} done, {len(self._pending)} pending>'
+
+    def submit(self, hashes):
+        """
+        Queue originals by Media.h; already queued ones are skipped.
+        :param hashes: iterable of Media.h
+        """
+        with self._cond:
+            new = [h for h in hashes if h not in self._pending]
+            self._pending.update(new)
+
+        for h in new:
+            self._executor.submit(self._scale, h)
+
+    def submit_missing(self, db_query=None):
+        """
+        Queue every image that lacks a derivative for one of self.sizes. Candidates are all media
+        but audio (see Media.may_be_image); files that turn out not to be raster images get a
+        derivative row without data, so they are not queued again.
+        :param db_query: Media query to restrict to; defaults to all media
+        """
+        if db_query is None:
+            db_query = db.Media.select()
+
+        done = db.MediaDerivative.select(db.MediaDerivative.media) \
+            .where(db.MediaDerivative.size.in_(self.sizes)) \
+            .group_by(db.MediaDerivative.media) \
+            .having(pv.fn.COUNT(db.MediaDerivative.id) == len(self.sizes))
+        self.submit(h for h, in db_query.select(db.Media.h)
+                    .where((db.Media.type_ != MediaType.audio) & db.Media.h.not_in(done)).tuples())
+
+    def _scale(self, h):
+        rows = []
+        try:
+            data = db.Media.select(db.Media.data).where(db.Media.h == h).get().data
+            for size in self.sizes:
+                scaled = scale_image(data, size, self.format_, self.quality)
+                rows.append({
+                    'media': h,
+                    'size': size,
+                    'mime': scaled[1] if scaled else None,
+                    'data': scaled[0] if scaled else None
+                })
+        except Exception:
+            logging.exception('Cannot scale %s', h)
+
+        self._results.put((h, rows))
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batch = [self._results.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._results.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stop = True
+                batch = [item for item in batch if item is not None]
+
+            rows = [row for _, item_rows in batch for row in item_rows]
+            try:
+                with db.database.atomic():
+                    for row_batch in pv.chunked(rows, db.INSERT_BATCH_SIZE):
+                        db.MediaDerivative.insert_many(row_batch).on_conflict_replace().execute()
+            except Exception:
+                logging.exception('Cannot store %d derivatives', len(rows))
+
+            with self._cond:
+                for h, _ in batch:
+                    self._pending.discard(h)
+                self.n_done += len(batch)
+                self._cond.notify_all()
+
+        db.database.close()
+
+    def join(self, timeout=None):
+        """
+        Wait until everything queued so far is stored.
+        :return: True if nothing is pending
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, cancel=False):
+        """
+        :param bool cancel: drop queued images that haven't started yet
+        """
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        self._results.put(None)
+        self._writer.join()
+
+
+pool = None
+
+
+def start(sizes=SIZES, workers=4, fill=True, **kwargs):
+    """
+    Start the background pool. While it runs, rendering with max_image_px also queues
+    images that have no derivative yet.
+    :param tuple sizes:
+    :param int workers:
+    :param bool fill: queue every image that lacks a derivative
+    :param kwargs: see DerivativePool
+    :return: DerivativePool
+    """
+    global pool
+
+    stop()
+    pool = DerivativePool(sizes=sizes, workers=workers, **kwargs)
+    if fill:
+        pool.submit_missing()
+
+    return pool
+
+
+def stop(wait=True):
+    """
+    :param bool wait: let queued images finish first
+    """
+    global pool
+
+    if pool is not None:
+        pool.close(cancel=not wait)
+        pool = None
+
+
+def request(hashes):
+    """
+    Queue originals for the running pool, if any.
+    """
+    if pool is not None:
+        pool.submit(hashes)
@@ -0,0 +1,159 @@
+"""
+Static export of rendered cards, for offline web/mobile viewers.
+
+Layout of dst_dir:
+
+- ``plan.json`` -- card ids of each shard, fixed on the first run so that a rerun resumes
+- ``cards/<shard>.json`` (and ``cards/<shard>.html``) -- rendered cards
+- ``media/<Media.h>`` -- each media file written once, referenced by hash from the cards
+  (URLs are relative to dst_dir)
+- ``manifest.json`` -- shards, decks, and css/js per model; written last
+"""
+
+from multiprocessing import get_context
+from tqdm import tqdm
+import json
+import os
+
+from .config import config
+from .jupyter import HTML
+from . import db
+
+MEDIA_DIR = 'media'
+CARDS_DIR = 'cards'
+
+
+def _write_atomic(path, content, mode='w'):
+    tmp = path + '.tmp'
+    with open(tmp, mode) as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _init_worker(database, markdown):
+    db.database.init(database, readonly=True, immutable=False)
+    config['markdown'] = markdown
+    config['media_url'] = MEDIA_DIR + '/'
+
+
+def _render_shard(args):
+    shard, card_ids, dst_dir, formats = args
+    records = []
+    pages = []
+    for db_card in db.Card.load_for_render(card_ids):
+        question = db_card.question
+        answer = db_card._render_answer(question.raw)
+        records.append({
+            'id': db_card.id,
+            'note': db_card.note_id,
+            'deck': db_card.deck.name,
+            'model': db_card.template.model_id,
+            'template': db_card.template.name,
+            'tags': db_card._loaded['tags'],
+            'question': question.raw,
+            'answer': answer.raw
+        })
+        if 'html' in formats:
+            pages.append(db_card.html)
+
+    name = os.path.join(dst_dir, CARDS_DIR, '{:05d}'.format(shard))
+    if 'html' in formats:
+        _write_atomic(name + '.html', '<meta charset="utf-8">\n<base href="../">\n' + '<hr/>\n'.join(pages))
+    _write_atomic(name + '.json', json.dumps(records, ensure_ascii=False))
+
+    return shard, len(records)
+
+
+def export_static(dst_dir, db_query=None, shard_size=1000, processes=None, formats=('json',)):
+    """
+    Render every card of db_query across a process pool into sharded files.
+    Shards already written by a previous run are skipped.
+    :param str dst_dir:
+    :param db_query: Card query, e.g. Card.search(deck_name='foo'); defaults to all cards
+    :param int shard_size: cards per shard
+    :param int processes: defaults to os.cpu_count()
+    :param tuple formats: 'json' is always written; add 'html' for one standalone page per shard
+    :return: path of manifest.json
+    """
+    if db_query is None:
+        db_query = db.Card.select()
+
+    os.makedirs(os.path.join(dst_dir, CARDS_DIR), exist_ok=True)
+    os.makedirs(os.path.join(dst_dir, MEDIA_DIR), exist_ok=True)
+
+    plan_path = os.path.join(dst_dir, 'plan.json')
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            plan = json.load(f)
+    else:
+        card_ids = sorted(r[0] for r in db_query.select(db.Card.id).distinct().tuples())
+        plan = [card_ids[i:i + shard_size] for i in range(0, len(card_ids), shard_size)]
+        _write_atomic(plan_path, json.dumps(plan))
+
+    _export_media(dst_dir, plan)
+
+    todo = [(shard, card_ids, dst_dir, tuple(formats)) for shard, card_ids in enumerate(plan)
+            if not os.path.exists(os.path.join(dst_dir, CARDS_DIR, '{:05d}.json'.format(shard)))]
+    if todo:
+        with get_context('spawn').Pool(processes, initializer=_init_worker,
+                                       initargs=(db.database.path, config.get('markdown'))) as pool:
+            for _ in tqdm(pool.imap_unordered(_render_shard, todo), total=len(todo), desc='shards'):
+                pass
+
+    return _write_manifest(dst_dir, plan)
+
+
+def _export_media(dst_dir, plan):
+    card_ids = [card_id for shard in plan for card_id in shard]
+    media_ids = set()
+    for i in range(0, len(card_ids), 500):
+        chunk = card_ids[i:i + 500]
+        media_ids.update(r[0] for r in db.NoteMedia.select(db.NoteMedia.media)
+                         .join(db.Card, on=(db.Card.note == db.NoteMedia.note))
+                         .where(db.Card.id.in_(chunk)).tuples())
+        media_ids.update(r[0] for r in db.ModelFont.select(db.ModelFont.media)
+                         .join(db.Template, on=(db.Template.model == db.ModelFont.model))
+                         .join(db.Card).where(db.Card.id.in_(chunk)).tuples())
+
+    media_ids = list(media_ids)
+    existing = set(os.listdir(os.path.join(dst_dir, MEDIA_DIR)))
+    missing = []
+    for i in range(0, len(media_ids), 500):
+        missing.extend(media_id for media_id, h in db.Media.select(db.Media.id, db.Media.h)
+                       .where(db.Media.id.in_(media_ids[i:i + 500])).tuples() if h not in existing)
+
+    # blobs are read only for files not written by a previous run
+    for i in tqdm(range(0, len(missing), 100), desc='media'):
+        for h, data in db.Media.select(db.Media.h, db.Media.data) \
+                .where(db.Media.id.in_(missing[i:i + 100])).tuples().iterator():
+            _write_atomic(os.path.join(dst_dir, MEDIA_DIR, h), bytes(data), mode='wb')
+
+
+def _write_manifest(dst_dir, plan):
+    media_url = config.get('media_url')
+    config['media_url'] = MEDIA_DIR + '/'
+    try:
+        models = dict()
+        for db_model in db.Model.select():
+            html = HTML('', model=db_model)
+            models[db_model.id] = {
+                'name': db_model.name,
+                'css': html.raw_css,
+                'js': db_model.js
+            }
+    finally:
+        config['media_url'] = media_url
+
+    manifest = {
+        'shards': [{
+            'file': '{}/{:05d}.json'.format(CARDS_DIR, shard),
+            'count': len(card_ids)
+        } for shard, card_ids in enumerate(plan)],
+        'decks': {d.id: d.name for d in db.Deck.select()},
+        'models': models
+    }
+
+    path = os.path.join(dst_dir, 'manifest.json')
+    _write_atomic(path, json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    return path
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import logging
+import os
+import time
+import peewee as pv
+import magic
+from tqdm import tqdm
+
+from .util import media_type, md5_file
+from . import db
+
+
+class MediaIngest:
+    """
+    Media ingestion pipeline. Worker threads hash (streaming) and sniff files in parallel,
+    and read only those whose content is not stored yet; the calling thread writes them in
+    batches, with at most max_batch_bytes of file content in memory per batch, plus up to
+    2 * workers files read ahead. A few files (at most SYNC_MAX_FILES) are handled in the
+    calling thread, without starting any worker.
+
+    >>> ingest = MediaIngest(workers=8)
+    >>> name_to_id = ingest.run([('a.png', '/path/to/a.png'), ...])
+    >>> ingest.mb_per_s
+    """
+
+    SYNC_MAX_FILES = 8
+
+    def __init__(self, workers=4, batch_size=256, max_batch_bytes=64 << 20, type_=None, progress=True,
+                 strict=False):
+        """
+
+        :param int workers: reader threads
+        :param int batch_size: files per insert batch
+        :param int max_batch_bytes: flush a batch early once it holds this many bytes
+        :param type_: MediaType for every file, or None to sniff each file with magic
+        :param bool progress: show a tqdm bar, in bytes/s
+        :param bool strict: raise IntegrityError if a name already exists with different content,
+                            instead of logging and skipping it
+        """
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.type_ = type_
+        self.progress = progress
+        self.strict = strict
+        self._known = None
+
+        self.n_files = 0
+        self.n_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def mb_per_s(self):
+        if not self.seconds:
+            return 0.0
+
+        return self.n_bytes / self.seconds / 1e6
+
+    def __repr__(self):
+        return f'<MediaIngest: {self.n_files} files, {self.n_bytes / 1e6:.1f} MB, {self.mb_per_s:.1f} MB/s>'
+
+    def _read(self, name, path):
+        h = md5_file(path)
+        if self.type_ is not None:
+            type_ = self.type_
+        else:
+            with open(path, 'rb') as f:
+                type_ = media_type(magic.from_buffer(f.read(2048), mime=True))
+
+        return {
+            'name': name,
+            'path': path,
+            'size': os.path.getsize(path),
+            'h': h,
+            'type_': type_,
+            'data': None if self._is_stored(h) else self._read_data(path)
+        }
+
+    def _is_stored(self, h):
+        if self._known is None:
+            return db.Media.select().where(db.Media.h == h).exists()
+
+        return h in self._known
+
+    @staticmethod
+    def _read_data(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def run(self, files):
+        """
+
+        :param files: iterable of (name, path)
+        :return: dict of name to Media id
+        """
+        files = list(files)
+        name_to_id = dict()
+        start = time.time()
+        # stored hashes, so that workers don't read files already stored; a few files are looked up one by one
+        self._known = None if len(files) <= self.SYNC_MAX_FILES \
+            else set(r[0] for r in db.Media.select(db.Media.h).tuples().iterator())
+
+        pbar = tqdm(total=sum(os.path.getsize(p) for _, p in files), desc='media',
+                    unit='B', unit_scale=True, disable=not self.progress)
+        batch = []
+        batch_bytes = 0
+
+        def _collect(item, force=False):
+            nonlocal batch, batch_bytes
+            if item is not None:
+                batch.append(item)
+                batch_bytes += len(item['data'] or b'')
+
+            if batch and (force or len(batch) >= self.batch_size or batch_bytes >= self.max_batch_bytes):
+                name_to_id.update(self._write(batch, pbar))
+                batch, batch_bytes = [], 0
+
+        if len(files) <= self.SYNC_MAX_FILES:
+            for name, path in files:
+                _collect(self._read(name, path))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = deque()
+                for name, path in files:
+                    pending.append(executor.submit(self._read, name, path))
+                    if len(pending) >= self.workers * 2:
+                        _collect(pending.popleft().result())
+
+                while pending:
+                    _collect(pending.popleft().result())
+
+        _collect(None, force=True)
+        pbar.close()
+        self.seconds += time.time() - start
+
+        return name_to_id
+
+    def _write(self, batch, pbar):
+        Media, MediaAlias = db.Media, db.MediaAlias
+        name_to_id = dict()
+
+        with db.database.atomic():
+            aliased = dict(MediaAlias.select(MediaAlias.name, Media.h).join(Media)
+                           .where(MediaAlias.name.in_([item['name'] for item in batch])).tuples())
+
+            new_blobs = dict()
+            new_aliases = dict()
+            for item in batch:
+                name = item['name']
+                if name in aliased or name in new_aliases:
+                    if aliased.get(name, new_aliases.get(name)) != item['h']:
+                        if self.strict:
+                            raise pv.IntegrityError('{} already exists with different content'.format(name))
+                        logging.error('%s already exists with different content. Skipping...', name)
+                        aliased.pop(name, None)
+                    continue
+
+                new_aliases[name] = item['h']
+                new_blobs.setdefault(item['h'], item)
+
+            h_to_id = dict(Media.select(Media.h, Media.id)
+                           .where(Media.h.in_(list(new_blobs) + list(aliased.values()))).tuples())
+            rows = [{
+                'name': item['name'],
+                'type_': item['type_'],
+                'data': item['data'] if item['data'] is not None else self._read_data(item['path']),
+                'h': h,
+                'refs': 0
+            } for h, item in new_blobs.items() if h not in h_to_id]
+            for row_batch in pv.chunked(rows, db.INSERT_BATCH_SIZE):
+                Media.insert_many(row_batch).execute()
+
+            h_to_id.update(Media.select(Media.h, Media.id)
+                           .where(Media.h.in_([row['h'] for row in rows])).tuples())
+
+            alias_rows = [{'name': name, 'media': h_to_id[h]} for name, h in new_aliases.items()]
+            for row_batch in pv.chunked(alias_rows, db.INSERT_BATCH_SIZE):
+                MediaAlias.insert_many(row_batch).execute()
+
+            touched = list(set(h_to_id[h] for h in new_aliases.values()))
+            if touched:
+                Media.update(refs=MediaAlias.select(pv.fn.COUNT(MediaAlias.id))
+                             .where(MediaAlias.media == Media.id)) \
+                    .where(Media.id.in_(touched)).execute()
+
+            for name, h in list(aliased.items()) + list(new_aliases.items()):
+                name_to_id[name] = h_to_id[h]
+
+        size = sum(item['size'] for item in batch)
+        self.n_files += len(batch)
+        self.n_bytes += size
+        pbar.update(size)
+
+        return name_to_id
+
+
+def ingest_media(files, **kwargs):
+    """
+    Shortcut for MediaIngest(**kwargs).run(files)
+    :param files: iterable of (name, path)
+    :return: dict of name to Media id
+    """
+    return MediaIngest(**kwargs).run(files)
@@ -3,13 +3,21 @@ from .config import config
 
 
 class HTML:
-    def __init__(self, html, media=None, model=None):
+    def __init__(self, html, media=None, model=None, fonts=None, max_image_px=None, inline_media=False):
+        """
+        :param bool inline_media: always inline media as data URIs, ignoring config['media_url'] and max_image_px
+        """
         if media is None:
             media = []
+        if max_image_px is None:
+            max_image_px = config.get('max_image_px')
 
         self.media = media
         self._raw = do_markdown(html)
         self.model = model
+        self.fonts = fonts
+        self.max_image_px = max_image_px
+        self.inline_media = inline_media
 
     def _repr_html_(self):
         return self.html
@@ -34,10 +42,15 @@ class HTML:
         result = self._raw
 
         for medium in self.media:
-            if medium.type_ == MediaType.audio:
-                result = result.replace(f'[sound:{medium.name}]', medium.html)
+            if self.inline_media:
+                url = medium.src
+            else:
+                url = medium.url if not self.max_image_px else medium.scaled_url(self.max_image_px)
+            for name in medium.names:
+                if medium.type_ == MediaType.audio:
+                    result = result.replace(f'[sound:{name}]', medium.to_html(inline=self.inline_media))
 
-            result = result.replace(medium.name, medium.src)
+                result = result.replace(name, url)
 
         return result
 
@@ -47,7 +60,9 @@ class HTML:
 
         if self.model:
             css += self.model.css
-            for font in self.model.fonts:
-                css = css.replace(font.name, font.src)
+            fonts = self.fonts if self.fonts is not None else self.model.fonts
+            for font in fonts:
+                for name in font.names:
+                    css = css.replace(name, font.url)
 
         return css
@@ -0,0 +1,234 @@
+"""
+Review state of many learners over one shared collection.
+
+Card content (note, template, deck) stays in the .ankix file, which can then be opened
+read-only and shared; each learner's srs_level / next_review and review history live in
+a separate, small state database, keyed by (learner_id, card_id). Grading writes only
+to the state database.
+
+>>> from ankix import ankix, learners
+>>> ankix.init('shared.ankix', readonly=True)
+>>> learners.init('state.db')
+>>> alice = learners.Learner('alice')
+>>> for card in alice.iter_quiz(deck_path='Japanese'):
+...     alice.right(card)
+"""
+
+from datetime import datetime, timedelta
+from array import array
+import peewee as pv
+from playhouse import sqlite_ext
+
+from . import db
+
+state_database = sqlite_ext.SqliteDatabase(None)
+
+
+class StateModel(pv.Model):
+    class Meta:
+        database = state_database
+
+
+class LearnerCard(StateModel):
+    """
+    Review state of one card for one learner; cards never graded have no row, i.e. they are new.
+    """
+    learner_id = pv.TextField()
+    card = pv.IntegerField()  # Card.id in the content database
+    srs_level = pv.IntegerField(null=True)
+    next_review = pv.DateTimeField(null=True)
+
+    class Meta:
+        primary_key = pv.CompositeKey('learner_id', 'card')
+        indexes = [
+            (('learner_id', 'next_review'), False),
+        ]
+
+    def __repr__(self):
+        return f'<LearnerCard: {self.learner_id} {self.card} {self.srs_level}>'
+
+
+class LearnerReview(StateModel):
+    """
+    Append-only review history, like db.Review, per learner.
+    """
+    learner_id = pv.TextField()
+    card = pv.IntegerField()
+    timestamp = pv.DateTimeField(default=datetime.now)
+    grade = pv.IntegerField()
+    prev_level = pv.IntegerField(default=0)
+    new_level = pv.IntegerField(default=0)
+    response_time = pv.FloatField(null=True)  # seconds
+
+    class Meta:
+        indexes = [
+            (('learner_id', 'timestamp'), False),
+            (('learner_id', 'card'), False),
+        ]
+
+    def __repr__(self):
+        return f'<LearnerReview: {self.learner_id} {self.card} {self.grade}>'
+
+
+def init(database, **kwargs):
+    """
+    Open (or create) the state database, in WAL mode so that grading doesn't block readers.
+    :param str database: path, e.g. 'state.db'; ':memory:' also works
+    :param kwargs: passed to SqliteDatabase.init
+    :return:
+    """
+    pragmas = dict(kwargs.pop('pragmas', None) or ())
+    pragmas.setdefault('journal_mode', 'wal')
+    state_database.init(database, pragmas=pragmas, **kwargs)
+    state_database.create_tables([LearnerCard, LearnerReview], safe=True)
+
+
+def _card_id(card):
+    return card if isinstance(card, int) else card.id
+
+
+class Learner:
+    """
+    One learner's view of the content database: quiz order, due cards and grading,
+    with the same SRS steps as Card.right() / Card.wrong().
+    """
+
+    def __init__(self, learner_id):
+        self.learner_id = str(learner_id)
+
+    def __repr__(self):
+        return f'<Learner: {self.learner_id}>'
+
+    def get_state(self, card_ids, chunk_size=500):
+        """
+        :param card_ids: iterable of Card.id
+        :param int chunk_size:
+        :return: dict of card id to (srs_level, next_review); new cards are absent
+        """
+        card_ids = list(card_ids)
+        state = dict()
+        for i in range(0, len(card_ids), chunk_size):
+            state.update((card_id, (srs_level, next_review)) for card_id, srs_level, next_review in
+                         LearnerCard.select(LearnerCard.card, LearnerCard.srs_level, LearnerCard.next_review)
+                         .where((LearnerCard.learner_id == self.learner_id)
+                                & LearnerCard.card.in_(card_ids[i:i + chunk_size])).tuples())
+
+        return state
+
+    def _set(self, card, srs_level, next_review, grade=None, prev_level=None, response_time=None):
+        card_id = _card_id(card)
+        with state_database.atomic():
+            LearnerCard.insert(learner_id=self.learner_id, card=card_id,
+                               srs_level=srs_level, next_review=next_review).on_conflict_replace().execute()
+            if grade is not None:
+                LearnerReview.insert(learner_id=self.learner_id, card=card_id, grade=grade,
+                                     prev_level=prev_level or 0, new_level=srs_level or 0,
+                                     response_time=response_time).execute()
+
+        if isinstance(card, db.Card):
+            card.srs_level, card.next_review = srs_level, next_review
+
+    def _level(self, card):
+        return self.get_state([_card_id(card)]).get(_card_id(card), (None, None))[0]
+
+    def right(self, card, response_time=None):
+        """
+        :param card: Card or Card.id
+        :param float response_time: seconds
+        """
+        prev_level = self._level(card)
+        srs_level, next_review = db.srs_right(prev_level)
+        self._set(card, srs_level, next_review, db.Review.RIGHT, prev_level, response_time)
+
+    correct = next_srs = right
+
+    def wrong(self, card, duration=timedelta(minutes=1), response_time=None):
+        prev_level = self._level(card)
+        srs_level = db.srs_wrong(prev_level)
+        self._set(card, srs_level, datetime.now() + duration, db.Review.WRONG, prev_level, response_time)
+
+    incorrect = previous_srs = wrong
+
+    def bury(self, card, duration=timedelta(hours=4)):
+        self._set(card, self._level(card), datetime.now() + duration)
+
+    def reschedule(self, policy='last_review', chunk_size=100000):
+        """
+        Like Card.reschedule, for this learner's cards.
+        :param str policy: 'last_review' or 'now'
+        :param int chunk_size:
+        :return: number of cards rescheduled
+        """
+        if policy not in db.Card.RESCHEDULE_POLICIES:
+            raise ValueError('policy must be one of {}'.format(db.Card.RESCHEDULE_POLICIES))
+
+        where = ' AND learnercard.learner_id = ?'
+        if policy == 'last_review':
+            base = ('coalesce((SELECT max(r.timestamp) FROM learnerreview AS r '
+                    'WHERE r.learner_id = learnercard.learner_id AND r.card = learnercard.card), ?)')
+        else:
+            base = '?'
+
+        return db.reschedule_rows(state_database, 'learnercard', base, where, (self.learner_id,), chunk_size)
+
+    def not_due_ids(self, now=None):
+        """
+        Cards scheduled later than now, from the (learner_id, next_review) index.
+        :return: set of Card.id
+        """
+        if now is None:
+            now = datetime.now()
+
+        return set(r[0] for r in LearnerCard.select(LearnerCard.card)
+                   .where((LearnerCard.learner_id == self.learner_id) & (LearnerCard.next_review > now))
+                   .tuples().iterator())
+
+    def due_ids(self, db_query=None, now=None, new=True):
+        """
+        :param db_query: Card query, e.g. Card.search(deck_name='foo'); defaults to all cards
+        :param datetime now:
+        :param bool new: include cards that this learner has never graded
+        :return: shuffled array('q') of Card.id
+        """
+        if db_query is None:
+            db_query = db.Card.select()
+
+        card_ids = db.Card.shuffled_ids(db_query)
+        not_due = self.not_due_ids(now)
+        if new:
+            return array('q', (card_id for card_id in card_ids if card_id not in not_due))
+
+        graded = self.graded_ids()
+
+        return array('q', (card_id for card_id in card_ids if card_id in graded and card_id not in not_due))
+
+    def graded_ids(self):
+        """
+        :return: set of Card.id that this learner has a state for
+        """
+        return set(r[0] for r in LearnerCard.select(LearnerCard.card)
+                   .where(LearnerCard.learner_id == self.learner_id).tuples().iterator())
+
+    def iter_quiz(self, template_name=None, model_name=None, deck_name=None, tags=None, deck_path=None,
+                  batch_size=50, new=True):
+        """
+        Due cards of this learner in random order, hydrated batch_size at a time, with
+        srs_level and next_review set from the state database (the content file is not written).
+        :return: generator of Card
+        """
+        card_ids = self.due_ids(db.Card.search(
+            template_name=template_name,
+            model_name=model_name,
+            deck_name=deck_name,
+            tags=tags,
+            deck_path=deck_path
+        ), new=new)
+        for i in range(0, len(card_ids), batch_size):
+            db_cards = db.Card.load_for_render(card_ids[i:i + batch_size])
+            state = self.get_state(c.id for c in db_cards)
+            for db_card in db_cards:
+                db_card.srs_level, db_card.next_review = state.get(db_card.id, (None, None))
+
+            yield from db_cards
+
+    iter_due = iter_quiz
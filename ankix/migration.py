@@ -1,72 +1,283 @@
 import peewee as pv
+from playhouse import sqlite_ext
 from playhouse.migrate import SqliteMigrator, migrate
+from tqdm import tqdm
+import hashlib
+import json
 
 from . import db
+from .util import parse_cloze
 
+VERSIONS = ('0.1.4', '0.1.5', '0.1.6', '0.2', '0.2.1', '0.2.2', '0.2.3', '0.2.4', '0.2.5')
+assert VERSIONS[-1] == db.SCHEMA_VERSION
 
-def do_migrate(src_version, dst_version, forced=False):
-    migrator = SqliteMigrator(db.database)
-
-    if (src_version, dst_version) == ('0.1.4', '0.1.5'):
-        with db.database.atomic():
-            for table_name in ['media', 'template', 'note', 'card']:
-                try:
-                    migrate(
-                        migrator.add_column(table_name, 'h', pv.TextField(unique=True, null=True))
-                    )
-                except pv.OperationalError:
-                    pass
-
-            db.create_all_tables()
-
-            for record in db.Media.select():
-                try:
-                    record.h = ''
-                    record.save()
-                except pv.IntegrityError:
-                    print('{} is duplicated: {}'.format(record.id, record.name))
-                    if not forced:
-                        raise
-                    else:
-                        record.delete_instance()
-
-            for record in db.Template.select():
-                try:
-                    record.h = ''
-                    record.save()
-                except pv.IntegrityError:
-                    print('{} is duplicated: {}'.format(record.id, record.question + record.answer))
-                    if not forced:
-                        raise
-                    else:
-                        record.delete_instance()
-
-            for record in db.Note.select():
-                try:
-                    data = record.data
-                    for k, v in data.items():
-                        record.data[k] = str(v)
-                    record.save()
-                except pv.IntegrityError:
-                    print('{} is duplicated: {}'.format(record.id, record.data))
-                    if not forced:
-                        raise
-                    else:
-                        record.delete_instance()
-
-            for record in db.Card.select():
-                try:
-                    record.h = ''
-                    record.save()
-                except pv.IntegrityError:
-                    print('{} is duplicated: {}'.format(record.id, record.question.raw))
-                    if not forced:
-                        raise
-                    else:
-                        record.delete_instance()
-    elif (src_version, dst_version) == ('0.1.5', '0.1.6'):
-        migrate(
-            migrator.add_column('model', 'js', pv.TextField(default=''))
-        )
-    else:
-        raise ValueError('Not supported for {}, {}'.format(src_version, dst_version))
+
+class Context:
+    def __init__(self, forced, chunk_size):
+        self.migrator = SqliteMigrator(db.database)
+        self.forced = forced
+        self.chunk_size = chunk_size
+        self.step = None
+
+
+def do_migrate(src_version=None, dst_version=VERSIONS[-1], forced=False, chunk_size=1000):
+    """
+    Upgrade the open database one version at a time. Backfills run in chunks, each
+    in its own transaction together with a checkpoint in SchemaVersion, so calling
+    do_migrate() again after a crash resumes where it stopped.
+    :param str src_version: only needed for files without a stored schema version (before 0.2.3)
+    :param str dst_version:
+    :param bool forced: delete duplicated rows instead of raising IntegrityError
+    :param int chunk_size: rows per transaction
+    :return:
+    """
+    db.SchemaVersion.create_table()
+    state = db.SchemaVersion.get_or_none()
+    if state is None:
+        if src_version is None:
+            raise ValueError('No schema version is stored in the database; src_version is required')
+        state = db.SchemaVersion.create(version=src_version)
+    elif src_version is not None and src_version != state.version:
+        raise ValueError('Database is at version {}, not {}'.format(state.version, src_version))
+
+    if state.version not in VERSIONS or dst_version not in VERSIONS \
+            or VERSIONS.index(state.version) > VERSIONS.index(dst_version):
+        raise ValueError('Not supported for {}, {}'.format(state.version, dst_version))
+
+    ctx = Context(forced=forced, chunk_size=chunk_size)
+    path = VERSIONS[VERSIONS.index(state.version):VERSIONS.index(dst_version) + 1]
+    for src, dst in zip(path, path[1:]):
+        resume_from = state.step
+        for func in MIGRATIONS.get((src, dst), []):
+            ctx.step = '{}:{}'.format(dst, func.__name__)
+            if resume_from is not None:
+                if ctx.step != resume_from:
+                    continue
+                resume_from = None
+            else:
+                _checkpoint(ctx.step, 0)
+
+            func(ctx)
+
+        db.SchemaVersion.update(version=dst, step=None, last_id=None).execute()
+        state = db.SchemaVersion.get()
+
+
+def _checkpoint(step, last_id):
+    db.SchemaVersion.update(step=step, last_id=last_id).execute()
+
+
+def _run_chunked(ctx, model, func):
+    """
+    Call func(ids) for chunks of model ids, in id order, from the last checkpoint.
+    """
+    state = db.SchemaVersion.get()
+    last_id = state.last_id if state.step == ctx.step and state.last_id else 0
+
+    with tqdm(total=model.select().where(model.id > last_id).count(), desc=ctx.step) as pbar:
+        while True:
+            ids = [r[0] for r in model.select(model.id)
+                   .where(model.id > last_id).order_by(model.id)
+                   .limit(ctx.chunk_size).tuples()]
+            if not ids:
+                break
+
+            with db.database.atomic():
+                func(ids)
+                last_id = ids[-1]
+                _checkpoint(ctx.step, last_id)
+
+            pbar.update(len(ids))
+
+
+def _backfill_hash(ctx, model, compute):
+    """
+    Set h (and any other columns) returned by compute(ids) -> {id: {column: value}},
+    with one executemany per chunk. Rows whose h is already taken are duplicates.
+    """
+    table = model._meta.table_name
+
+    def _chunk(ids):
+        values = compute(ids)
+        hashes = [v['h'] for v in values.values()]
+        taken = dict(model.select(model.h, model.id)
+                     .where(model.h.in_(hashes) & model.id.not_in(ids)).tuples())
+
+        rows = []
+        for record_id, v in values.items():
+            if v['h'] in taken:
+                print('{} is duplicated: {}'.format(record_id, taken[v['h']]))
+                if not ctx.forced:
+                    raise pv.IntegrityError('{}.h is duplicated: {}'.format(table, record_id))
+                model.delete().where(model.id == record_id).execute()
+            else:
+                taken[v['h']] = record_id
+                rows.append([v[c] for c in sorted(v)] + [record_id])
+
+        if rows:
+            columns = sorted(next(iter(values.values())))
+            db.database.cursor().executemany(
+                'UPDATE "{}" SET {} WHERE id = ?'.format(table, ', '.join('"{}" = ?'.format(c) for c in columns)),
+                rows
+            )
+
+    _run_chunked(ctx, model, _chunk)
+
+
+def _add_column(ctx, table_name, column_name, field):
+    try:
+        migrate(ctx.migrator.add_column(table_name, column_name, field))
+    except pv.OperationalError:
+        pass
+
+
+# 0.1.4 -> 0.1.5
+
+def add_hash_columns(ctx):
+    with db.database.atomic():
+        for table_name in ['media', 'template', 'note', 'card']:
+            _add_column(ctx, table_name, 'h', pv.TextField(unique=True, null=True))
+
+        db.create_all_tables()
+
+
+def hash_media(ctx):
+    def _compute(ids):
+        return {i: {'h': hashlib.md5(bytes(data)).hexdigest()} for i, data in
+                db.Media.select(db.Media.id, db.Media.data).where(db.Media.id.in_(ids)).tuples()}
+
+    _backfill_hash(ctx, db.Media, _compute)
+
+
+def hash_template(ctx):
+    def _compute(ids):
+        return {i: {'h': hashlib.md5((q + a).encode()).hexdigest()} for i, q, a in
+                db.Template.select(db.Template.id, db.Template.question, db.Template.answer)
+                .where(db.Template.id.in_(ids)).tuples()}
+
+    _backfill_hash(ctx, db.Template, _compute)
+
+
+def hash_note(ctx):
+    def _compute(ids):
+        values = dict()
+        for i, data in db.Note.select(db.Note.id, db.Note.data).where(db.Note.id.in_(ids)).tuples():
+            d = {k: str(v) for k, v in data.items() if v not in {None, ''}}
+            values[i] = {
+                'data': json.dumps(d),
+                'h': hashlib.md5(json.dumps(d, sort_keys=True).encode()).hexdigest()
+            }
+
+        return values
+
+    _backfill_hash(ctx, db.Note, _compute)
+
+
+def hash_card(ctx):
+    _backfill_hash(ctx, db.Card, lambda ids: {
+        c.id: {'h': db.card_hash(c)} for c in _load_legacy_cards(ids)
+    })
+
+
+def _load_legacy_cards(ids):
+    """
+    Card.load_for_render, restricted to the columns that exist in 0.1.5
+    """
+    db_cards = list(db.Card.select(db.Card.id, db.Card.note, db.Card.template, db.Card.cloze_order,
+                                   db.Note.id, db.Note.data, db.Note.model,
+                                   db.Template.id, db.Template.question, db.Template.model,
+                                   db.Model.id, db.Model.css)
+                    .join(db.Note).switch(db.Card)
+                    .join(db.Template).join(db.Model)
+                    .where(db.Card.id.in_(ids)))
+    media_columns = (db.Media.id, db.Media.name, db.Media.type_, db.Media.data)
+
+    note_media = dict()
+    for r in db.NoteMedia.select(db.NoteMedia.note, *media_columns).join(db.Media) \
+            .where(db.NoteMedia.note.in_([c.note_id for c in db_cards])):
+        r.media._names = [r.media.name]
+        note_media.setdefault(r.note_id, []).append(r.media)
+
+    model_fonts = dict()
+    for r in db.ModelFont.select(db.ModelFont.model, *media_columns).join(db.Media) \
+            .where(db.ModelFont.model.in_([c.template.model_id for c in db_cards])):
+        r.media._names = [r.media.name]
+        model_fonts.setdefault(r.model_id, []).append(r.media)
+
+    for db_card in db_cards:
+        db_card._loaded = {
+            'media': note_media.get(db_card.note_id, []),
+            'fonts': model_fonts.get(db_card.template.model_id, []),
+            'tags': []
+        }
+
+    return db_cards
+
+
+# 0.1.5 -> 0.1.6
+
+def add_model_js(ctx):
+    _add_column(ctx, 'model', 'js', pv.TextField(default=''))
+
+
+# 0.2 -> 0.2.1
+
+def add_media_alias(ctx):
+    with db.database.atomic():
+        _add_column(ctx, 'media', 'refs', pv.IntegerField(default=1))
+        db.MediaAlias.create_table()
+        db.MediaAlias.insert_from(
+            db.Media.select(db.Media.name, db.Media.id)
+                .where(db.Media.name.not_in(db.MediaAlias.select(db.MediaAlias.name))),
+            [db.MediaAlias.name, db.MediaAlias.media]
+        ).execute()
+
+
+# 0.2.1 -> 0.2.2
+
+def add_note_cloze(ctx):
+    _add_column(ctx, 'note', 'cloze', sqlite_ext.JSONField(null=True))
+
+
+def parse_note_cloze(ctx):
+    def _chunk(ids):
+        rows = []
+        for record_id, data in db.Note.select(db.Note.id, db.Note.data).where(db.Note.id.in_(ids)).tuples():
+            cloze = parse_cloze(data)
+            if cloze is not None:
+                rows.append((json.dumps(cloze), record_id))
+
+        if rows:
+            db.database.cursor().executemany('UPDATE "note" SET cloze = ? WHERE id = ?', rows)
+
+    _run_chunked(ctx, db.Note, _chunk)
+
+
+# 0.2.2 -> 0.2.3
+
+def add_review_log(ctx):
+    db.Review.create_table()
+    db.SchemaVersion.create_table()
+
+
+# 0.2.3 -> 0.2.4
+
+def add_compression_dict(ctx):
+    db.CompressionDict.create_table()
+
+
+# 0.2.4 -> 0.2.5
+
+def add_media_derivative(ctx):
+    db.MediaDerivative.create_table()
+
+
+MIGRATIONS = {
+    ('0.1.4', '0.1.5'): [add_hash_columns, hash_media, hash_template, hash_note, hash_card],
+    ('0.1.5', '0.1.6'): [add_model_js],
+    ('0.2', '0.2.1'): [add_media_alias],
+    ('0.2.1', '0.2.2'): [add_note_cloze, parse_note_cloze],
+    ('0.2.2', '0.2.3'): [add_review_log],
+    ('0.2.3', '0.2.4'): [add_compression_dict],
+    ('0.2.4', '0.2.5'): [add_media_derivative]
+}
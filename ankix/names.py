@@ -0,0 +1,124 @@
+"""
+In-memory index of entity names (Deck, Model, Template, Tag), so that name filters
+resolve to an id set without a LIKE '%x%' scan joined against the card table.
+"""
+
+from bisect import bisect_left
+import peewee as pv
+
+HIERARCHY_SEP = '::'
+
+
+class NameIndex:
+    """
+    Trigram index over the lowercased names of one model, for substring lookups,
+    plus a sorted list for prefix and deck-hierarchy lookups.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.stale = True
+        self._fingerprint = None
+        self._names = dict()
+        self._trigrams = dict()
+        self._sorted = []
+
+    def _current_fingerprint(self):
+        return self.model.select(pv.fn.COUNT(self.model.id), pv.fn.MAX(self.model.id)).tuples()[0]
+
+    def refresh(self):
+        """
+        Rebuild if the model was saved or deleted in this process (see db signals), or if
+        the row count or max id changed (e.g. another process wrote to the file).
+        Bulk renames with Model.update() are not detected; call invalidate() after them.
+        """
+        fingerprint = self._current_fingerprint()
+        if not self.stale and fingerprint == self._fingerprint:
+            return self
+
+        names = {i: name.lower() for i, name in self.model.select(self.model.id, self.model.name).tuples()}
+        trigrams = dict()
+        for i, name in names.items():
+            for k in range(len(name) - 2):
+                trigrams.setdefault(name[k:k + 3], set()).add(i)
+
+        self._names, self._trigrams = names, trigrams
+        self._sorted = sorted((name, i) for i, name in names.items())
+        self._fingerprint = fingerprint
+        self.stale = False
+
+        return self
+
+    def contains(self, s):
+        """
+        Case-insensitive substring match, like Field.contains()
+        :param str s:
+        :return: set of ids
+        """
+        s = s.lower()
+        if len(s) < 3:
+            return set(i for i, name in self._names.items() if s in name)
+
+        candidates = None
+        for k in range(len(s) - 2):
+            ids = self._trigrams.get(s[k:k + 3], set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return set()
+
+        return set(i for i in candidates if s in self._names[i])
+
+    def prefix(self, s):
+        """
+        :param str s:
+        :return: set of ids whose name starts with s (case-insensitive)
+        """
+        s = s.lower()
+        result = set()
+        for name, i in self._sorted[bisect_left(self._sorted, (s,)):]:
+            if not name.startswith(s):
+                break
+            result.add(i)
+
+        return result
+
+    def exact(self, names):
+        """
+        :param list names:
+        :return: set of ids whose name is any of names (case-insensitive)
+        """
+        names = set(n.lower() for n in names)
+
+        return set(i for i, name in self._names.items() if name in names)
+
+    def subtree(self, path):
+        """
+        A hierarchical name, e.g. a Deck 'Parent::Child', and all of its descendants.
+        :param str path:
+        :return: set of ids
+        """
+        return self.exact([path]) | self.prefix(path + HIERARCHY_SEP)
+
+
+_indexes = dict()
+
+
+def name_index(model):
+    """
+    :param model: Deck, Model, Template or Tag
+    :return: an up-to-date NameIndex for the model
+    """
+    if model not in _indexes:
+        _indexes[model] = NameIndex(model)
+
+    return _indexes[model].refresh()
+
+
+def invalidate(model):
+    if model in _indexes:
+        _indexes[model].stale = True
+
+
+def invalidate_all():
+    for index in _indexes.values():
+        index.stale = True
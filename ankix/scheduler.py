@@ -0,0 +1,178 @@
+from array import array
+from datetime import datetime, timedelta
+import time
+
+from . import db
+
+
+class RelearnHeap:
+    """
+    Min-heap of (due timestamp, card id), kept in two parallel arrays (16 bytes per entry).
+    """
+    __slots__ = ('_due', '_ids')
+
+    def __init__(self):
+        self._due = array('d')
+        self._ids = array('q')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __bool__(self):
+        return len(self._ids) > 0
+
+    def push(self, due, card_id):
+        self._due.append(due)
+        self._ids.append(card_id)
+        self._sift_up(len(self._ids) - 1)
+
+    def peek(self):
+        return self._due[0], self._ids[0]
+
+    def pop(self):
+        due, card_id = self._due.pop(), self._ids.pop()
+        if not self._ids:
+            return due, card_id
+
+        top = self._due[0], self._ids[0]
+        self._due[0], self._ids[0] = due, card_id
+        self._sift_down(0)
+
+        return top
+
+    def _swap(self, i, j):
+        self._due[i], self._due[j] = self._due[j], self._due[i]
+        self._ids[i], self._ids[j] = self._ids[j], self._ids[i]
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._due[i] >= self._due[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self._ids)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._due[child] < self._due[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+
+class Session:
+    """
+    In-process quiz session. Cards answered wrong come back after `relearn`, interleaved
+    with the due queue, without re-querying the database. Once the due queue is exhausted,
+    iteration sleeps until the next relearn card is due; with wait=False it stops instead,
+    and can be resumed after `next_relearn`. Grades are written back in batches of
+    `batch_size` cards, and on flush() or when the session ends.
+
+    >>> with Session(Card.iter_quiz(deck_name='foo')) as session:
+    ...     for card in session:
+    ...         session.right(card)
+    """
+    __slots__ = ('cards', 'relearn', 'batch_size', 'wait', '_heap', '_pending')
+
+    def __init__(self, cards=None, relearn=timedelta(minutes=1), batch_size=100, wait=True):
+        """
+
+        :param cards: iterable of Card for the due queue. Defaults to Card.iter_quiz()
+        :param timedelta relearn: delay before a card answered wrong comes back
+        :param int batch_size: number of graded cards kept before writing to the database
+        :param bool wait: when only relearn cards are left, sleep until the next one is due,
+                          rather than stop iterating
+        """
+        if cards is None:
+            cards = db.Card.iter_quiz()
+
+        self.cards = iter(cards)
+        self.relearn = relearn
+        self.batch_size = batch_size
+        self.wait = wait
+        self._heap = RelearnHeap()
+        self._pending = dict()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._heap and self._heap.peek()[0] <= time.time():
+            return self._get(self._heap.pop()[1])
+
+        try:
+            return next(self.cards)
+        except StopIteration:
+            if self._heap and self.wait:
+                time.sleep(max(0.0, self._heap.peek()[0] - time.time()))
+                return self._get(self._heap.pop()[1])
+
+            self.flush()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def __len__(self):
+        """
+        :return: number of cards waiting to be relearnt
+        """
+        return len(self._heap)
+
+    @property
+    def next_relearn(self):
+        if not self._heap:
+            return None
+
+        return datetime.fromtimestamp(self._heap.peek()[0])
+
+    def _get(self, card_id):
+        db_card = self._pending.get(card_id)
+        if db_card is None:
+            db_card = db.Card.load_for_render([card_id])[0]
+
+        return db_card
+
+    def _stage(self, card):
+        self._pending[card.id] = card
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def right(self, card, response_time=None):
+        card.right(save=False, response_time=response_time)
+        self._stage(card)
+
+    correct = right
+
+    def wrong(self, card, duration=None, response_time=None):
+        if duration is None:
+            duration = self.relearn
+
+        card.wrong(duration, save=False, response_time=response_time)
+        self._heap.push(card.next_review.timestamp(), card.id)
+        self._stage(card)
+
+    incorrect = wrong
+
+    def bury(self, card, duration=timedelta(hours=4)):
+        card.bury(duration, save=False)
+        self._stage(card)
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        with db.database.atomic():
+            db.Card.bulk_update(list(self._pending.values()),
+                                fields=[db.Card.srs_level, db.Card.next_review],
+                                batch_size=self.batch_size)
+        self._pending.clear()
+        db.Review.flush()
@@ -0,0 +1,232 @@
+"""
+Small local HTTP server for rendered cards and media.
+
+Routes:
+
+- ``/card/<id>``, ``/card/<id>/question``, ``/card/<id>/answer`` -- rendered HTML
+- ``/media/<Media.h>`` -- the raw blob, with a strong ETag (the content MD5),
+  ``Cache-Control: immutable`` and single ``Range`` support
+- ``/media/<Media.h>?px=<size>`` -- a downscaled image (see ankix.derivatives)
+
+Cards accept ``?px=<size>`` too, to reference image derivatives of at most that size.
+
+While the server runs, ``config['media_url']`` is set, so rendered cards
+reference ``/media/<h>`` instead of inlining base64 data URIs, and browsers
+cache media across cards. Jupyter rendering without the server keeps data URIs.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import re
+import peewee as pv
+import magic
+
+from .config import config
+from .compress import MAGIC as COMPRESSED_MAGIC
+from . import db
+
+MEDIA_PREFIX = '/media/'
+RE_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+_mime = dict()
+
+
+def get_mime(h, data=None):
+    if h not in _mime:
+        if data is None:
+            data = db.Media.select(pv.fn.substr(db.Media.data, 1, 2048).coerce(False).alias('head'))\
+                .where(db.Media.h == h).scalar()
+        _mime[h] = magic.from_buffer(bytes(data[:2048]), mime=True)
+
+    return _mime[h]
+
+
+def load_compressed(h):
+    """
+    :param str h:
+    :return: the decompressed blob if it is stored compressed (see ankix.compress), otherwise None,
+             so that uncompressed blobs are still sliced in SQL without loading them whole
+    """
+    if 'media' not in db.get_codecs().kinds:
+        return None
+
+    head = db.Media.select(pv.fn.substr(db.Media.data, 1, 4).coerce(False)).where(db.Media.h == h).scalar()
+    if head is None or bytes(head) != COMPRESSED_MAGIC:
+        return None
+
+    return db.Media.select(db.Media.data).where(db.Media.h == h).get().data
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header, size):
+    """
+    :param str header: value of the Range header
+    :param int size: full content length
+    :return: (start, end) inclusive, or None if the header can't be used (malformed, or several
+             ranges), in which case the full content is sent
+    :raise RangeNotSatisfiable: if the range starts past the end of the content
+    """
+    m = RE_RANGE.match(header.strip())
+    if m is None:
+        return None
+
+    start, end = m.groups()
+    if not start:
+        if not end:
+            return None
+        if int(end) == 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(size - int(end), 0), size - 1
+
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+class AnkixHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def do_GET(self, head_only=False):
+        with db.database.connection_context():
+            path, _, query = self.path.partition('?')
+            px = parse_qs(query).get('px', [''])[0]
+            px = int(px) if px.isdigit() else None
+            if path.startswith(MEDIA_PREFIX) and px:
+                self._send_derivative(path[len(MEDIA_PREFIX):], px, head_only)
+            elif path.startswith(MEDIA_PREFIX):
+                self._send_media(path[len(MEDIA_PREFIX):], head_only)
+            elif path.startswith('/card/'):
+                self._send_card(path[len('/card/'):], head_only, px)
+            else:
+                self.send_error(404)
+
+    def _send_card(self, spec, head_only, max_image_px=None):
+        card_id, _, side = spec.partition('/')
+        db_cards = db.Card.load_for_render([int(card_id)], max_image_px=max_image_px) if card_id.isdigit() else []
+        if not db_cards or side not in {'', 'question', 'answer'}:
+            self.send_error(404)
+            return
+
+        db_card = db_cards[0]
+
+        body = (db_card.html if not side else str(getattr(db_card, side))).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def _send_derivative(self, h, px, head_only):
+        db_derivative = db.MediaDerivative.get_or_none(media=h, size=px)
+        if db_derivative is None or db_derivative.data is None:
+            self.send_error(404)
+            return
+
+        etag = f'"{h}-{px}"'
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        body = bytes(db_derivative.data)
+        self.send_response(200)
+        self.send_header('Content-Type', db_derivative.mime)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def _send_media(self, h, head_only):
+        data = load_compressed(h)
+        if data is None:
+            size = db.Media.select(pv.fn.length(db.Media.data)).where(db.Media.h == h).scalar()
+        else:
+            size = len(data)
+        if size is None:
+            self.send_error(404)
+            return
+
+        etag = f'"{h}"'
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = parse_range(self.headers['Range'], size)
+            except RangeNotSatisfiable:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', get_mime(h, data))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+
+        if not head_only and size:
+            if data is None:
+                chunk = db.Media.select(pv.fn.substr(db.Media.data, start + 1, end - start + 1).coerce(False))\
+                    .where(db.Media.h == h).scalar()
+            else:
+                chunk = data[start:end + 1]
+            self.wfile.write(bytes(chunk))
+
+
+def make_server(host='127.0.0.1', port=8000, media_url=MEDIA_PREFIX):
+    """
+    Create the server and point config['media_url'] at it. Call after ankix.init.
+    :param str host:
+    :param int port:
+    :param str media_url: use an absolute URL, e.g. 'http://localhost:8000/media/',
+                          if cards are displayed from another origin
+    :return: ThreadingHTTPServer
+    """
+    config['media_url'] = media_url
+
+    return ThreadingHTTPServer((host, port), AnkixHandler)
+
+
+def serve(host='127.0.0.1', port=8000, media_url=MEDIA_PREFIX):
+    server = make_server(host, port, media_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        config['media_url'] = None
+
+
+if __name__ == '__main__':
+    import sys
+    from .ankix import init
+
+    init(sys.argv[1])
+    serve(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
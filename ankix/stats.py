@@ -0,0 +1,132 @@
+"""
+Retention statistics over the review log, vectorized with NumPy (`pip install ankix[stats]`).
+
+>>> from ankix import stats
+>>> reviews = stats.load_reviews()
+>>> stats.retention_by_level(reviews)
+{0: (0.71, 1520), 1: (0.83, 1204), ...}
+"""
+
+from array import array
+import numpy as np
+import peewee as pv
+
+from . import db
+
+COLUMNS = (
+    ('card_id', 'q'),
+    ('deck_id', 'q'),
+    ('timestamp', 'd'),
+    ('grade', 'q'),
+    ('prev_level', 'q'),
+    ('new_level', 'q'),
+    ('response_time', 'd')
+)
+
+
+def load_reviews(deck_name=None, since=None, chunk_size=65536):
+    """
+    Load the review log into one NumPy array per column, streaming the cursor in chunks.
+    :param str deck_name: substring of Deck.name, as in Card.search
+    :param datetime since:
+    :param int chunk_size:
+    :return: dict of column name to np.ndarray; missing response times are NaN
+    """
+    db.Review.flush()
+
+    unix_time = (pv.fn.julianday(db.Review.timestamp) - 2440587.5) * 86400.0
+    db_query = db.Review.select(
+        db.Review.card, db.Card.deck, unix_time, db.Review.grade,
+        db.Review.prev_level, db.Review.new_level, db.Review.response_time
+    ).join(db.Card)
+    if deck_name:
+        db_query = db_query.join(db.Deck).where(db.Deck.name.contains(deck_name))
+    if since:
+        db_query = db_query.where(db.Review.timestamp >= since)
+
+    columns = [array(t) for _, t in COLUMNS]
+    nan = float('nan')
+    cursor = db.database.execute(db_query.order_by(db.Review.id))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        for card_id, deck_id, timestamp, grade, prev_level, new_level, response_time in rows:
+            columns[0].append(card_id)
+            columns[1].append(deck_id)
+            columns[2].append(timestamp)
+            columns[3].append(grade)
+            columns[4].append(prev_level)
+            columns[5].append(new_level)
+            columns[6].append(nan if response_time is None else response_time)
+
+    return {name: np.frombuffer(col, dtype=t) for (name, t), col in zip(COLUMNS, columns)}
+
+
+def _grouped_retention(keys, grades):
+    if not len(keys):
+        return dict()
+
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    total = np.bincount(inverse)
+    right = np.bincount(inverse, weights=grades)
+
+    return {k.item(): (float(r / n), int(n)) for k, r, n in zip(uniq, right, total)}
+
+
+def retention_by_level(reviews):
+    """
+    :param dict reviews: from load_reviews
+    :return: dict of srs level before the review to (retention, number of reviews)
+    """
+    return _grouped_retention(reviews['prev_level'], reviews['grade'])
+
+
+def retention_by_deck(reviews):
+    """
+    :param dict reviews: from load_reviews
+    :return: dict of deck id to (retention, number of reviews)
+    """
+    return _grouped_retention(reviews['deck_id'], reviews['grade'])
+
+
+def review_intervals(reviews):
+    """
+    Seconds since the previous review of the same card, NaN for a card's first review.
+    :param dict reviews: from load_reviews
+    :return: np.ndarray aligned with reviews
+    """
+    order = np.lexsort((reviews['timestamp'], reviews['card_id']))
+    card_id = reviews['card_id'][order]
+    timestamp = reviews['timestamp'][order]
+
+    sorted_intervals = np.full(len(order), np.nan)
+    if len(order) > 1:
+        same_card = card_id[1:] == card_id[:-1]
+        sorted_intervals[1:] = np.where(same_card, np.diff(timestamp), np.nan)
+
+    intervals = np.empty_like(sorted_intervals)
+    intervals[order] = sorted_intervals
+
+    return intervals
+
+
+def retention_by_interval(reviews, bins=None):
+    """
+    :param dict reviews: from load_reviews
+    :param list bins: interval bin edges in seconds; defaults to the config['srs'] ladder
+    :return: dict of bin lower edge in seconds to (retention, number of reviews)
+    """
+    if bins is None:
+        bins = [0] + [td.total_seconds() for td in db.srs_table.refresh().intervals]
+
+    bins = np.unique(np.asarray(bins, dtype='d'))  # the ladder needn't be monotonic
+    intervals = review_intervals(reviews)
+    has_interval = ~np.isnan(intervals)
+
+    idx = np.digitize(intervals[has_interval], bins) - 1
+    idx = np.clip(idx, 0, len(bins) - 1)
+
+    return {bins[k].item(): v for k, v in
+            _grouped_retention(idx, reviews['grade'][has_interval]).items()}
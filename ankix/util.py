@@ -6,9 +6,13 @@ import mistune
 from pathlib import Path
 import base64
 import mimetypes
+import hashlib
+from functools import lru_cache
 
 markdown = mistune.Markdown()
+MARKDOWN_CACHE_SIZE = 4096
 RE_IS_HTML = re.compile(r"(?:</[^<]+>)|(?:<[^<]+/>)")
+RE_CLOZE = re.compile(r'{{c(\d+)::([^}]+)}}')
 
 
 def is_html(s):
@@ -21,6 +25,13 @@ class MediaType:
     audio = 'audio'
 
 
+def media_type(mime):
+    return {
+        'audio': MediaType.audio,
+        'font': MediaType.font
+    }.get(mime.split('/')[0], MediaType.image)
+
+
 def timedelta2str(x):
     if isinstance(x, str):
         x = timedelta(seconds=timeparse(x))
@@ -31,30 +42,116 @@ def timedelta2str(x):
 def parse_srs(value, default):
     if isinstance(value, (list, tuple, dict)):
         if isinstance(value, dict):
-            d = default
+            d = dict(default) if isinstance(default, dict) else dict(enumerate(default))
             for k, v in value.items():
                 d[int(k)] = v
 
-            value = d
+            value = [d[k] for k in sorted(d)]
     else:
         raise ValueError
 
     return json.dumps([timedelta2str(x) for x in value])
 
 
-def do_markdown(s):
-    from .config import config
-    if config.get('markdown'):
+@lru_cache(maxsize=32)
+def load_srs(s):
+    """
+    :param str s: JSON list of durations, as stored in Settings._srs
+    :return: tuple of timedelta, by srs level
+    """
+    return tuple(timedelta(seconds=timeparse(x)) for x in json.loads(s))
+
+
+@lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def _render_markdown(s, use_markdown):
+    if use_markdown:
         return markdown(s)
 
     return s
 
 
-def build_base64(fp):
+def do_markdown(s):
+    from .config import config
+    return _render_markdown(s, bool(config.get('markdown')))
+
+
+def markdown_cache_info():
+    """
+    :return: CacheInfo(hits, misses, maxsize, currsize)
+    """
+    return _render_markdown.cache_info()
+
+
+def clear_markdown_cache():
+    _render_markdown.cache_clear()
+
+
+def md5_file(fp, chunk_size=1 << 16):
+    """
+    MD5 a file while streaming it, without holding the whole file in memory.
+    :param str|Path fp:
+    :param int chunk_size:
+    :return: hexdigest
+    """
+    h = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def parse_cloze(data):
+    """
+    Split the cloze deletions out of note fields once, so that rendering doesn't rescan them.
+    :param dict data: note fields
+    :return: None if there is no cloze, else {'ords': [1, 2, ...], 'fields': {field: segments}},
+             where segments is a list of str and [ord, text]
+    """
+    ords = set()
+    fields = dict()
+    for k, v in data.items():
+        v = str(v)
+        segments = []
+        i = 0
+        for m in RE_CLOZE.finditer(v):
+            if m.start() > i:
+                segments.append(v[i:m.start()])
+            segments.append([int(m.group(1)), m.group(2)])
+            ords.add(int(m.group(1)))
+            i = m.end()
+
+        if i:
+            if i < len(v):
+                segments.append(v[i:])
+            fields[k] = segments
+
+    if not fields:
+        return None
+
+    return {
+        'ords': sorted(ords),
+        'fields': fields
+    }
+
+
+def render_cloze(segments, hidden=None):
+    """
+    :param list segments: from parse_cloze
+    :param int hidden: cloze ordinal to replace with [...], or None to show all
+    :return: str
+    """
+    return ''.join(seg if isinstance(seg, str)
+                   else ('[...]' if seg[0] == hidden else seg[1])
+                   for seg in segments)
+
+
+def build_base64(fp, mime=None):
     """
     Build data URI according to RFC 2397
     (data:[<mediatype>][;base64],<data>)
     :param str|Path|bytes fp:
+    :param str mime: skip sniffing the type of bytes
     :return:
     """
     if isinstance(fp, (str, Path)) and Path(fp).is_file():
@@ -65,9 +162,10 @@ def build_base64(fp):
         except ImportError:
             mime, _ = mimetypes.guess_type(str(fp))
     else:
-        import magic
         b = fp
-        mime = magic.from_buffer(fp, mime=True)
+        if mime is None:
+            import magic
+            mime = magic.from_buffer(fp, mime=True)
 
     data64 = base64.b64encode(b).decode()
 
@@ -0,0 +1,197 @@
+"""
+Query-plan regression checks for the search and quiz APIs.
+
+Builds a generated collection, runs EXPLAIN QUERY PLAN on the SQL that each API generates,
+and fails if an expected index isn't used, if the card or note table is fully scanned,
+or if a query is slower than its threshold.
+
+    $ python -m dev.check_query_plans --notes 20000
+"""
+
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+import argparse
+import random
+import time
+import sys
+import os
+import re
+
+from ankix import ankix, db
+
+GUARDED_TABLES = {'card', 'note'}
+RE_ALIAS = re.compile(r'"(\w+)" AS "(\w+)"')
+RE_SCAN = re.compile(r'SCAN (?:TABLE )?(\w+)')
+RE_TABLE_KEYWORD = re.compile(r'\b(SCAN|SEARCH) TABLE ')  # SQLite < 3.36
+RE_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+
+def build_collection(path, n_notes=20000, n_decks=25, n_tags=7):
+    """
+    Two models, decks nested two levels deep ('P<i>::C<j>'), one tag per chunk of notes
+    """
+    ankix.init(path)
+    db_model = db.Model.add(name='basic', templates=[
+        {'name': 'Forward', 'question': '{{Front}}', 'answer': '{{FrontSide}}<hr>{{Back}}'},
+        {'name': 'Reverse', 'question': '{{Back}}', 'answer': '{{FrontSide}}<hr>{{Front}}'}
+    ])
+    db.Model.add(name='other', templates=[
+        {'name': 'Only', 'question': '{{Front}}', 'answer': '{{Back}}'}
+    ])
+
+    decks = ['P{}::C{}'.format(i // 5, i % 5) for i in range(n_decks)]
+    chunk = 500
+    for k in range(0, n_notes, chunk):
+        db.Note.add_many(({'Front': 'front {}'.format(i), 'Back': 'back {}'.format(i)}
+                          for i in range(k, min(k + chunk, n_notes))),
+                         db_model, {'Forward': decks[k // chunk % n_decks], 'Reverse': decks[(k // chunk + 3) % n_decks]},
+                         tags=['tag{}'.format(k // chunk % n_tags)], chunk_size=chunk)
+
+
+@contextmanager
+def capture_sql():
+    """
+    Collect (sql, params) of every statement run inside the block
+    """
+    statements = []
+    execute_sql = db.database.execute_sql
+
+    def _execute_sql(sql, params=None):
+        statements.append((sql, params))
+        return execute_sql(sql, params)
+
+    db.database.execute_sql = _execute_sql
+    try:
+        yield statements
+    finally:
+        del db.database.execute_sql
+
+
+def explain(sql, params):
+    """
+    :return: EXPLAIN QUERY PLAN details, with table aliases replaced by table names,
+             and 'SCAN TABLE x' / 'SEARCH TABLE x' of older SQLite shortened to 'SCAN x' / 'SEARCH x'
+    """
+    aliases = {alias: table for table, alias in RE_ALIAS.findall(sql)}
+    details = []
+    for row in db.database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall():
+        detail = RE_TABLE_KEYWORD.sub(r'\1 ', row[-1])
+        details.append(re.sub(r'\b(t\d+)\b', lambda m: aliases.get(m.group(1), m.group(1)), detail))
+
+    return details
+
+
+class Case:
+    def __init__(self, name, run, indexes=(), allow_scan=(), max_ms=100.0):
+        """
+
+        :param str name:
+        :param run: callable running the API call
+        :param tuple indexes: index names that must appear in the plans
+        :param tuple allow_scan: guarded tables that may be scanned, e.g. 'note' for substring search in data
+        :param float max_ms: best-of-3 wall time
+        """
+        self.name = name
+        self.run = run
+        self.indexes = indexes
+        self.allow_scan = set(allow_scan)
+        self.max_ms = max_ms
+
+    def check(self, scale=1.0):
+        """
+        :return: (list of plan details, ms, list of problems)
+        """
+        with capture_sql() as statements:
+            self.run()
+
+        details = []
+        for sql, params in statements:
+            if sql.lstrip().upper().startswith('SELECT'):
+                details.extend(explain(sql, params))
+
+        problems = []
+        for detail in details:
+            m = RE_SCAN.match(detail)
+            if m and m.group(1) in GUARDED_TABLES - self.allow_scan:
+                problems.append('full scan: ' + detail)
+
+        used = set(i for detail in details for i in RE_INDEX.findall(detail))
+        problems.extend('index not used: ' + i for i in self.indexes if i not in used)
+
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            self.run()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        ms = min(timings)
+        if ms > self.max_ms * scale:
+            problems.append('too slow: {:.1f} ms > {:.1f} ms'.format(ms, self.max_ms * scale))
+
+        return details, ms, problems
+
+
+def _ids(db_query):
+    return [r[0] for r in db_query.select(db_query.model.id).tuples()]
+
+
+def get_cases():
+    card_ids = _ids(db.Card.select())
+    sample_ids = random.Random(0).sample(card_ids, 50)
+
+    return [
+        Case('Card.search(deck_name)', lambda: _ids(db.Card.search(deck_name='P1::')), ['card_deck_id']),
+        Case('Card.search(deck_path)', lambda: _ids(db.Card.search(deck_path='P1')), ['card_deck_id']),
+        Case('Card.search(template_name)', lambda: _ids(db.Card.search(template_name='Only')), ['card_template_id']),
+        Case('Card.search(model_name)', lambda: _ids(db.Card.search(model_name='other')),
+             ['card_template_id', 'template_model_id']),
+        Case('Card.search(tags)', lambda: _ids(db.Card.search(tags=['tag1'])),
+             ['card_note_id', 'notetagthrough_tag_id']),
+        Case('Card.search(deck_path, tags)', lambda: _ids(db.Card.search(deck_path='P1', tags=['tag1'])),
+             ['notetagthrough_tag_id']),
+        # a substring of a field can only be found by reading every note
+        Case('Card.search(data)', lambda: _ids(db.Card.search(data={'Front': 'front 12'})),
+             ['card_note_id'], allow_scan=['note'], max_ms=200.0),
+        Case('Note.search(deck_name)', lambda: _ids(db.Note.search(deck_name='P1::')), ['card_deck_id']),
+        Case('Note.search(model_name)', lambda: _ids(db.Note.search(model_name='other')), ['note_model_id']),
+        Case('Note.search(tags)', lambda: _ids(db.Note.search(tags=['tag1'])), ['notetagthrough_tag_id']),
+        Case('Card.load_for_render(50)', lambda: db.Card.load_for_render(sample_ids),
+             ['notemediathrough_note_id_media_id', 'modelmediathrough_model_id_media_id',
+              'notetagthrough_note_id_tag_id']),
+        Case('Card.iter_quiz(deck_path), first batch', lambda: next(db.Card.iter_quiz(deck_path='P1', batch_size=50)),
+             ['card_deck_id', 'notetagthrough_note_id_tag_id'], max_ms=200.0)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--notes', type=int, default=20000, help='notes in the generated collection')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every time threshold, e.g. on slow CI')
+    parser.add_argument('--verbose', '-v', action='store_true', help='print the query plans')
+    args = parser.parse_args(argv)
+
+    with TemporaryDirectory() as temp_dir:
+        build_collection(os.path.join(temp_dir, 'plans.ankix'), n_notes=args.notes)
+
+        cases = get_cases()
+        n_failed = 0
+        for case in cases:
+            details, ms, problems = case.check(scale=args.scale)
+            print('{:4} {:45} {:8.1f} ms'.format('FAIL' if problems else 'ok', case.name, ms))
+            for problem in problems:
+                print('       ' + problem)
+            if args.verbose or problems:
+                for detail in details:
+                    print('         | ' + detail)
+
+            n_failed += bool(problems)
+
+        db.database.close()
+
+    print('{} of {} failed'.format(n_failed, len(cases)) if n_failed else 'all passed')
+
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())